@@ -1,8 +1,7 @@
-import matplotlib.pyplot as plt
 import warnings
 
 from config import *
-from madmom.utils.midi import *
+from notecache import load_midi
 from os import listdir
 
 
@@ -18,7 +17,9 @@ def main():
                 analyze_amplitude(file, genre)
 
 def analyze_amplitude(file, genre):
-    midi = MIDIFile.from_file('midi-' + genre + '/' + file)
+    import matplotlib.pyplot as plt
+
+    midi = load_midi('midi-' + genre + '/' + file)
     notes = midi.notes(unit='ticks')
 
     amplitudes = []
@@ -0,0 +1,461 @@
+import numpy as np
+import pickle
+
+from os import makedirs, rename
+from os.path import dirname, isdir, isfile
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# populate.py indexes the highest first note of every bar of the training
+# tracks as a dict of pitch: list of (title, genre, bar). Matching two
+# consecutive bars of a track against it used to cross-join the postings of
+# both pitches, which is quadratic in their length. A BarIndex keeps the
+# postings of each pitch sorted by (title, bar), so the postings of the second
+# pitch with the same title within a bar range are found by binary search.
+#
+# Large corpora are indexed with a StreamBuilder, which never holds more than
+# RUN_SIZE postings in memory: they are spilled to sorted runs on disk, which
+# are then merged chunk by chunk into the memory-mapped columns of the index.
+
+# name of the index written by populate.py and read by match.py
+INDEX_NAME = 'table'
+
+# extension of index directories, one .npy file per column
+INDEX_EXT = '.idx'
+
+# extension of the legacy pickled table
+TABLE_EXT = '.p'
+
+# (title, bar) pairs are packed into a single sortable key
+KEY_SPAN = 2 ** 32
+
+COLUMNS = ['pitches', 'starts', 'titles', 'genres', 'bars', 'keys']
+
+# number of postings a StreamBuilder holds before spilling them to a run
+RUN_SIZE = 1000000
+
+# number of postings read from each run at a time when merging
+CHUNK_SIZE = 65536
+
+# a posting of a run, sorted by (pitch, seq) where seq is the order in which
+# postings were added
+POSTING = np.dtype([
+    ('pitch', np.int64),
+    ('seq', np.int64),
+    ('title', np.int32),
+    ('genre', np.int32),
+    ('bar', np.int64)
+])
+
+# the (title, bar) key of a posting of a run, sorted by (pitch, key)
+POSTING_KEY = np.dtype([
+    ('pitch', np.int64),
+    ('key', np.int64)
+])
+
+class BarIndex():
+    """
+    The postings of a bar table, grouped by pitch.
+
+    === Attributes ===
+    @param numpy.ndarray pitches: the pitches of the table, sorted
+    @param numpy.ndarray starts: the postings of pitches[i] are the rows
+        starts[i] to starts[i + 1]
+    @param numpy.ndarray titles: the title id of each posting
+    @param numpy.ndarray genres: the genre id of each posting
+    @param numpy.ndarray bars: the bar of each posting
+    @param numpy.ndarray keys: the (title, bar) key of the postings of each
+        pitch, sorted within the pitch
+    @param list[str] title_names: the title of each title id
+    @param list[str] genre_names: the genre of each genre id
+    """
+
+    def __init__(self, pitches, starts, titles, genres, bars, keys,
+            title_names, genre_names):
+        """
+        Creates an index from its columns. The postings of each pitch are in
+        the order they were added to the table, and keys is sorted within each
+        pitch.
+
+        @rtype: None
+        """
+        self.pitches = pitches
+        self.starts = starts
+        self.titles = titles
+        self.genres = genres
+        self.bars = bars
+        self.keys = keys
+        self.title_names = list(title_names)
+        self.genre_names = list(genre_names)
+        self._segments = dict((p, i) for i, p in enumerate(pitches.tolist()))
+
+    def __len__(self):
+        """
+        Return the number of postings in this index.
+
+        @param BarIndex self: this index
+        @rtype: int
+        """
+        return len(self.titles)
+
+    def __contains__(self, pitch):
+        """
+        Return whether pitch occurs in this index.
+
+        @param BarIndex self: this index
+        @param float pitch: a MIDI pitch
+        @rtype: bool
+        """
+        return pitch in self._segments
+
+    def lookup(self, pitch):
+        """
+        Return the range of rows holding the postings of pitch.
+
+        @param BarIndex self: this index
+        @param float pitch: a MIDI pitch
+        @rtype: (int, int)
+        """
+        i = self._segments.get(pitch)
+        if i is None:
+            return 0, 0
+        return int(self.starts[i]), int(self.starts[i + 1])
+
+    def find_consecutive(self, first, second, tolerance):
+        """
+        Return a (title, genre) for every pair of postings of the same title
+        where first occurs in a bar and second occurs 1 to tolerance + 1 bars
+        later, in the order the postings of first were added.
+
+        @param BarIndex self: this index
+        @param float first: the pitch of the earlier bar
+        @param float second: the pitch of the later bar
+        @param int tolerance: the number of bars the gap may exceed 1 by
+        @rtype: list[(str, str)]
+        """
+        if first not in self or second not in self:
+            return []
+
+        start, end = self.lookup(first)
+        second_start, second_end = self.lookup(second)
+        keys = self.keys[second_start:second_end]
+
+        base = self.titles[start:end].astype(np.int64) * KEY_SPAN + \
+            self.bars[start:end]
+        counts = np.searchsorted(keys, base + 1 + tolerance, side='right') - \
+            np.searchsorted(keys, base + 1, side='left')
+
+        rows = np.repeat(np.arange(start, end), counts)
+        return [(self.title_names[t], self.genre_names[g])
+            for t, g in zip(self.titles[rows], self.genres[rows])]
+
+    def save(self, path):
+        """
+        Save this index to the directory path, replacing any index already
+        saved there.
+
+        @param BarIndex self: this index
+        @param str path: the index directory
+        @rtype: None
+        """
+        tmp_path = path + '.tmp'
+        if isdir(tmp_path):
+            rmtree(tmp_path)
+        makedirs(tmp_path)
+
+        for column in COLUMNS:
+            np.save('{}/{}.npy'.format(tmp_path, column),
+                getattr(self, column))
+        save_names(tmp_path, self.title_names, self.genre_names)
+        replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load the index saved in the directory path. The postings are
+        memory-mapped unless mmap is False.
+
+        @param str path: the index directory
+        @param bool mmap: whether to memory-map the postings
+        @rtype: BarIndex
+        """
+        mode = 'r' if mmap else None
+        columns = [np.load('{}/{}.npy'.format(path, c), mmap_mode=mode)
+            for c in COLUMNS]
+        return cls(*columns,
+            title_names=np.load(path + '/title_names.npy').tolist(),
+            genre_names=np.load(path + '/genre_names.npy').tolist())
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Convert a table (a dict of pitch: list of (title, genre, bar)) into an
+        index.
+
+        @param dict(float: list[tuple]) table: the bar table
+        @rtype: BarIndex
+        """
+        title_ids = {}
+        genre_ids = {}
+        pitches = sorted(table.keys())
+        starts = [0]
+        rows = []
+        for pitch in pitches:
+            for title, genre, bar in table[pitch]:
+                title_id = title_ids.setdefault(title, len(title_ids))
+                genre_id = genre_ids.setdefault(genre, len(genre_ids))
+                rows.append((title_id, genre_id, bar))
+            starts.append(len(rows))
+
+        rows = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        titles = rows[:,0].astype(np.int32)
+        bars = rows[:,2]
+        keys = titles.astype(np.int64) * KEY_SPAN + bars
+        for start, end in zip(starts[:-1], starts[1:]):
+            keys[start:end].sort()
+
+        return cls(np.array(pitches, dtype=np.float64),
+            np.array(starts, dtype=np.int64), titles,
+            rows[:,1].astype(np.int32), bars, keys,
+            sorted(title_ids, key=title_ids.get),
+            sorted(genre_ids, key=genre_ids.get))
+
+def load_index(name=INDEX_NAME):
+    """
+    Load the index called name (a path without extension), converting a
+    legacy pickled table of the same name if that is all there is. Return
+    None if neither exists.
+
+    @param str name: the path of the index, without extension
+    @rtype: BarIndex
+    """
+    if isdir(name + INDEX_EXT):
+        return BarIndex.load(name + INDEX_EXT)
+
+    if isfile(name + TABLE_EXT):
+        index = BarIndex.from_table(pickle.load(open(name + TABLE_EXT, 'rb')))
+        index.save(name + INDEX_EXT)
+        return index
+
+    return None
+
+class StreamBuilder():
+    """
+    Builds a BarIndex from the bar sequences of tracks, with a bounded number
+    of postings in memory.
+
+    === Attributes ===
+    @param str path: the directory the index is written to
+    @param int run_size: the number of postings held before spilling them
+    @param list[str] title_names: the title of each title id
+    @param list[str] genre_names: the genre of each genre id
+    @param list[str] runs: the paths of the runs spilled so far
+    @param int postings: the number of postings added so far
+    """
+
+    def __init__(self, path, run_size=RUN_SIZE):
+        """
+        Creates a builder writing the index to the directory path.
+
+        @rtype: None
+        """
+        self.path = path
+        self.run_size = run_size
+        self.title_names = []
+        self.genre_names = []
+        self.runs = []
+        self.postings = 0
+        self._title_ids = {}
+        self._genre_ids = {}
+        self._buffer = []
+        self._buffered = 0
+        self._run_dir = mkdtemp(prefix='runs', dir=dirname(path) or '.')
+
+    def add_track(self, title, genre, pitches, bars):
+        """
+        Add the bar sequence of a track: the highest pitch of every bar and
+        the bar it occurs in.
+
+        @param StreamBuilder self: this builder
+        @param str title: the name of the file
+        @param str genre: the genre of the file
+        @param numpy.ndarray pitches: the pitch of each bar
+        @param numpy.ndarray bars: the bar of each pitch
+        @rtype: None
+        """
+        title_id = self._title_ids.setdefault(title, len(self._title_ids))
+        if title_id == len(self.title_names):
+            self.title_names.append(title)
+        genre_id = self._genre_ids.setdefault(genre, len(self._genre_ids))
+        if genre_id == len(self.genre_names):
+            self.genre_names.append(genre)
+
+        postings = np.empty(len(pitches), dtype=POSTING)
+        postings['pitch'] = pitches
+        postings['seq'] = np.arange(self.postings,
+            self.postings + len(pitches))
+        postings['title'] = title_id
+        postings['genre'] = genre_id
+        postings['bar'] = bars
+        self.postings += len(pitches)
+
+        self._buffer.append(postings)
+        self._buffered += len(postings)
+        if self._buffered >= self.run_size:
+            self.spill()
+
+    def spill(self):
+        """
+        Write the buffered postings to a new run, sorted by (pitch, seq), and
+        their keys to another, sorted by (pitch, key).
+
+        @param StreamBuilder self: this builder
+        @rtype: None
+        """
+        if not self._buffer:
+            return
+
+        postings = np.concatenate(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        keys = np.empty(len(postings), dtype=POSTING_KEY)
+        keys['pitch'] = postings['pitch']
+        keys['key'] = postings['title'].astype(np.int64) * KEY_SPAN + \
+            postings['bar']
+
+        run = '{}/run{:05d}'.format(self._run_dir, len(self.runs))
+        np.save(run + '.postings.npy', postings[np.lexsort((postings['seq'],
+            postings['pitch']))])
+        np.save(run + '.keys.npy', keys[np.lexsort((keys['key'],
+            keys['pitch']))])
+        self.runs.append(run)
+
+    def build(self):
+        """
+        Merge the runs into the index directory and return the index.
+
+        @param StreamBuilder self: this builder
+        @rtype: BarIndex
+        """
+        self.spill()
+
+        tmp_path = self.path + '.tmp'
+        if isdir(tmp_path):
+            rmtree(tmp_path)
+        makedirs(tmp_path)
+
+        def column(name, dtype):
+            return np.lib.format.open_memmap('{}/{}.npy'.format(tmp_path,
+                name), mode='w+', dtype=dtype, shape=(self.postings,))
+
+        titles = column('titles', np.int32)
+        genres = column('genres', np.int32)
+        bars = column('bars', np.int64)
+        keys = column('keys', np.int64)
+
+        # postings are merged in (pitch, seq) order, which is the order of
+        # BarIndex.from_table, counting the postings of each pitch
+        counts = {}
+        written = 0
+        for chunk in merge_runs([np.load(run + '.postings.npy',
+                mmap_mode='r') for run in self.runs], 'seq'):
+            end = written + len(chunk)
+            titles[written:end] = chunk['title']
+            genres[written:end] = chunk['genre']
+            bars[written:end] = chunk['bar']
+            written = end
+            pitches, pitch_counts = np.unique(chunk['pitch'],
+                return_counts=True)
+            for pitch, count in zip(pitches.tolist(), pitch_counts.tolist()):
+                counts[pitch] = counts.get(pitch, 0) + count
+
+        written = 0
+        for chunk in merge_runs([np.load(run + '.keys.npy', mmap_mode='r')
+                for run in self.runs], 'key'):
+            keys[written:written + len(chunk)] = chunk['key']
+            written += len(chunk)
+
+        for memmap in titles, genres, bars, keys:
+            memmap.flush()
+        del titles, genres, bars, keys
+
+        pitches = sorted(counts)
+        np.save(tmp_path + '/pitches.npy', np.array(pitches,
+            dtype=np.float64))
+        np.save(tmp_path + '/starts.npy', np.r_[0,
+            np.cumsum([counts[p] for p in pitches], dtype=np.int64)])
+        save_names(tmp_path, self.title_names, self.genre_names)
+
+        replace(tmp_path, self.path)
+        self.close()
+        return BarIndex.load(self.path)
+
+    def close(self):
+        """
+        Remove the runs and any partly written index, which are left behind
+        if the build fails. Call it in a finally clause around the build.
+
+        @param StreamBuilder self: this builder
+        @rtype: None
+        """
+        for path in self._run_dir, self.path + '.tmp':
+            if isdir(path):
+                rmtree(path)
+
+def merge_runs(runs, field, chunk_size=CHUNK_SIZE):
+    """
+    Merge runs sorted by (pitch, field) into chunks in the same order, reading
+    at most chunk_size rows of each run at a time. Ties are taken from the
+    earlier run first.
+
+    @param list[numpy.ndarray] runs: the runs, usually memory-mapped
+    @param str field: the field the runs are sorted by within a pitch
+    @param int chunk_size: the number of rows read from each run at a time
+    @rtype: generator
+    """
+    positions = [0] * len(runs)
+    while True:
+        heads = [(i, run[positions[i]:positions[i] + chunk_size])
+            for i, run in enumerate(runs) if positions[i] < len(run)]
+        if not heads:
+            return
+
+        # every row up to the smallest last row of the heads can be merged,
+        # since no run has smaller rows left after its head
+        last = min((head[-1]['pitch'], head[-1][field]) for _, head in heads)
+        taken = []
+        for i, head in heads:
+            lo = np.searchsorted(head['pitch'], last[0], side='left')
+            hi = np.searchsorted(head['pitch'], last[0], side='right')
+            end = lo + np.searchsorted(head[field][lo:hi], last[1],
+                side='right')
+            taken.append(np.asarray(head[:end]))
+            positions[i] += end
+
+        chunk = np.concatenate(taken)
+        yield chunk[np.lexsort((chunk[field], chunk['pitch']))]
+
+def save_names(path, title_names, genre_names):
+    """
+    Save the title and genre names of an index to the directory path.
+
+    @param str path: the index directory
+    @param list[str] title_names: the title of each title id
+    @param list[str] genre_names: the genre of each genre id
+    @rtype: None
+    """
+    np.save(path + '/title_names.npy', np.array(title_names, dtype=np.str_))
+    np.save(path + '/genre_names.npy', np.array(genre_names, dtype=np.str_))
+
+def replace(tmp_path, path):
+    """
+    Move the index directory tmp_path to path, replacing any index there.
+
+    @param str tmp_path: the directory the index was written to
+    @param str path: the index directory
+    @rtype: None
+    """
+    if isdir(path):
+        rmtree(path)
+    rename(tmp_path, path)
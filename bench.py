@@ -0,0 +1,349 @@
+import numpy as np
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from multiprocessing import Process, Queue
+from shutil import rmtree
+from tempfile import mkdtemp
+from madmom.utils.midi import MIDIFile
+
+# Benchmarks for each stage of the pipeline, run against a synthetic corpus
+# so that results are reproducible and comparable across commits:
+#
+#   python bench.py --tracks 100 --notes 5000 --output before.json
+#   python bench.py --tracks 100 --notes 5000 --compare before.json
+#
+# Each stage runs in its own process, after an untimed setup (parsing the
+# corpus, building a database...), so its peak memory is not inflated by the
+# stages before it.
+
+GENRES = ['classical', 'rock']
+
+STAGES = ['parse', 'voices', 'fingerprint', 'build', 'match', 'classify',
+    'index', 'train']
+
+# time signatures the synthetic tracks are written in, unless given with
+# --time-signatures
+TIME_SIGNATURES = [(4, 4), (3, 4), (6, 8), (2, 4)]
+
+# note durations, in quarter notes
+DURATIONS = [0.25, 0.5, 0.5, 1, 1, 1, 2]
+
+TEMPO = 120
+RESOLUTION = 480
+
+def generate_track(rng, notes, channels):
+    """
+    Return a random note matrix (in seconds, as madmom writes it) with the
+    given number of notes spread over channels. Each channel is a random walk
+    over pitches whose intervals tend to repeat, like a melody.
+
+    @param numpy.random.RandomState rng: the random number generator
+    @param int notes: the number of notes
+    @param int channels: the number of channels
+    @rtype: numpy.ndarray
+    """
+    quarter = 60. / TEMPO
+    rows = []
+    for channel, count in enumerate(np.array_split(np.arange(notes),
+            channels)):
+        count = len(count)
+        durations = rng.choice(DURATIONS, count) * quarter
+        onsets = np.r_[0, np.cumsum(durations)[:-1]]
+
+        steps = rng.choice([-2, -1, 0, 1, 2, 5, -5], count)
+        repeats = rng.rand(count) < 0.5
+        steps[1:][repeats[1:]] = steps[:-1][repeats[1:]]
+        pitches = np.clip(48 + channel * 7 + np.cumsum(steps), 21, 108)
+
+        velocities = rng.randint(40, 110, count)
+        rows.append(np.c_[onsets, pitches, durations * 0.9, velocities,
+            np.full(count, channel)])
+
+    notes = np.vstack(rows)
+    return notes[np.lexsort((notes[:,1], notes[:,0]))]
+
+def generate_corpus(directory, tracks, notes, channels, seed,
+        time_signatures=TIME_SIGNATURES):
+    """
+    Write a synthetic corpus of MIDI files to directory, laid out like the
+    training set (a midi-<genre> directory per genre), plus a test-set
+    directory. Return the (file, genre, path) of every training track.
+
+    @param str directory: the directory of the corpus
+    @param int tracks: the number of training tracks
+    @param int notes: the number of notes per track
+    @param int channels: the number of channels per track
+    @param int seed: the seed of the random number generator
+    @param list[(int, int)] time_signatures: the time signatures tracks are
+        written in, each chosen at random
+    @rtype: list[tuple]
+    """
+    rng = np.random.RandomState(seed)
+    files = []
+    for i in range(tracks + max(tracks // 5, 1)):
+        genre = GENRES[i % len(GENRES)] if i < tracks else 'test'
+        folder = 'test-set' if genre == 'test' else 'midi-' + genre
+        if not os.path.isdir(os.path.join(directory, folder)):
+            os.makedirs(os.path.join(directory, folder))
+
+        file = 'synthetic{:05d}.mid'.format(i)
+        path = os.path.join(directory, folder, file)
+        signature = time_signatures[rng.randint(len(time_signatures))]
+        midi = MIDIFile.from_notes(generate_track(rng, notes, channels),
+            tempo=TEMPO, time_signature=signature, resolution=RESOLUTION)
+        midi.write(path)
+        if genre != 'test':
+            files.append((file, genre, path))
+    return files
+
+def parse_corpus(files):
+    from notecache import parse_midi
+    return [parse_midi(path).notes(unit='ticks') for _, _, path in files]
+
+def training_fingerprints(files):
+    import melody
+    return [melody.notes_fingerprints(file, notes)
+        for (file, _, _), notes in zip(files, parse_corpus(files))]
+
+def build_databases(files, fingerprints):
+    from fpdb import Builder
+    databases = {}
+    for variant in fingerprints[0]:
+        builder = Builder()
+        for (file, genre, _), track in zip(files, fingerprints):
+            builder.add_track(file, genre, track[variant])
+        databases[variant] = builder.build()
+    return databases
+
+def setup_parse(files):
+    from notecache import parse_midi
+    def run():
+        notes = 0
+        for _, _, path in files:
+            notes += len(parse_midi(path).notes(unit='ticks'))
+        return len(files), notes
+    return run
+
+def setup_voices(files):
+    import melody
+    tracks = parse_corpus(files)
+    def run():
+        for (file, _, _), notes in zip(files, tracks):
+            melody.analyze_voices(notes, melody.Track(file), 0)
+        return len(files), sum(len(notes) for notes in tracks)
+    return run
+
+def setup_fingerprint(files):
+    import melody
+    import fingerprint
+    peaks = []
+    for (file, _, _), notes in zip(files, parse_corpus(files)):
+        track = melody.Track(file)
+        melody.analyze_voices(notes, track, 0)
+        peaks.append(melody.melody_peaks(notes, track))
+    def run():
+        count = 0
+        for track in peaks:
+            for hash_function in fingerprint.HASH_FUNCTIONS:
+                count += len(hash_function(track))
+        return len(files), count
+    return run
+
+def setup_build(files):
+    fingerprints = training_fingerprints(files)
+    def run():
+        databases = build_databases(files, fingerprints)
+        return len(files), sum(len(d) for d in databases.values())
+    return run
+
+def setup_match(files):
+    from pitches import join
+    fingerprints = training_fingerprints(files)
+    databases = build_databases(files, fingerprints)
+    variant = sorted(databases)[0]
+    def run():
+        matches = 0
+        for track in fingerprints:
+            matches += len(join(databases[variant], track[variant]))
+        return len(files), matches
+    return run
+
+def setup_classify(files):
+    import melody
+    from config import get_classical
+    from fpdb import VariantDB
+    from pitches import count_variant_genres
+    databases = build_databases(files, training_fingerprints(files))
+    index = VariantDB.from_databases(databases, sorted(databases))
+    tests = [(file, 'test', os.path.join('test-set', file))
+        for file in sorted(os.listdir('test-set'))]
+    tracks = parse_corpus(tests)
+    def run():
+        for (file, _, _), notes in zip(tests, tracks):
+            fingerprints = melody.notes_fingerprints(file, notes)
+            for genres in count_variant_genres(index, fingerprints).values():
+                get_classical(genres)
+        return len(tests), len(tests) * len(databases)
+    return run
+
+def setup_index(files):
+    import populate
+    from notecache import load_midi
+
+    # populate reads tracks through the note cache, so fill it beforehand
+    for _, _, path in files:
+        load_midi(path)
+    def run():
+        table = {}
+        for file, genre, _ in files:
+            populate.midi_train(table, file, 'midi-' + genre + '/')
+        return len(files), sum(len(v) for v in table.values())
+    return run
+
+def setup_train(files):
+    import nn_genres
+    rng = np.random.RandomState(len(files))
+    features = rng.rand(len(files), 20)
+    labels = np.zeros((len(files), 2))
+    labels[np.arange(len(files)), rng.randint(2, size=len(files))] = 1
+    def run():
+        nn_genres.base_NN(features, labels, features, labels)
+        return len(files), len(files)
+    return run
+
+def run_stage(stage, directory, files, results):
+    """
+    Set up and time one stage, in a child process, putting its measurements
+    on the results queue.
+
+    @param str stage: the name of the stage
+    @param str directory: the directory of the corpus
+    @param list[tuple] files: the (file, genre, path) of every training track
+    @param Queue results: where the measurements are put
+    @rtype: None
+    """
+    os.chdir(directory)
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        run = globals()['setup_' + stage](files)
+    except ImportError as e:
+        results.put({'skipped': str(e)})
+        return
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    tracks, items = run()
+    seconds = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    results.put({
+        'seconds': round(seconds, 4),
+        'tracks': tracks,
+        'items': items,
+        'tracks_per_second': round(tracks / seconds, 2) if seconds else None,
+        'items_per_second': round(items / seconds, 2) if seconds else None,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(rss_after / 1024., 2),
+        'stage_rss_mb': round((rss_after - rss_before) / 1024., 2)
+    })
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report, baseline):
+    """
+    Print the time of each stage against a baseline report.
+
+    @param dict report: the report of this run
+    @param dict baseline: the report of an earlier run
+    @rtype: None
+    """
+    print '{:<12} {:>10} {:>10} {:>8}'.format('stage', 'baseline', 'now',
+        'ratio')
+    for stage, result in report['stages'].items():
+        before = baseline['stages'].get(stage, {})
+        if 'seconds' not in result or 'seconds' not in before:
+            continue
+        ratio = result['seconds'] / before['seconds'] if before['seconds'] \
+            else float('nan')
+        print '{:<12} {:>10.4f} {:>10.4f} {:>8.2f}'.format(stage,
+            before['seconds'], result['seconds'], ratio)
+
+def get_time_signatures(value):
+    """
+    Parse a comma separated list of time signatures, such as 4/4,6/8.
+
+    @param str value: the command line value
+    @rtype: list[(int, int)]
+    """
+    try:
+        signatures = [tuple(int(part) for part in signature.split('/'))
+            for signature in value.split(',')]
+    except ValueError:
+        signatures = None
+    if not signatures or any(len(s) != 2 or min(s) <= 0 for s in signatures):
+        raise argparse.ArgumentTypeError('expected time signatures such as '
+            '4/4,6/8, not {}'.format(value))
+    return signatures
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the pipeline '
+        'on a synthetic MIDI corpus')
+    parser.add_argument('--tracks', type=int, default=40)
+    parser.add_argument('--notes', type=int, default=2000,
+        help='notes per track')
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--time-signatures', type=get_time_signatures,
+        default=TIME_SIGNATURES, metavar='N/D,...',
+        help='time signatures tracks are written in (default: {})'.format(
+            ','.join('{}/{}'.format(*s) for s in TIME_SIGNATURES)))
+    parser.add_argument('--stages', default=','.join(STAGES),
+        help='comma separated, from: ' + ', '.join(STAGES))
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--compare', help='a JSON report to compare with')
+    args = parser.parse_args()
+
+    directory = mkdtemp(prefix='bench')
+    try:
+        config = {'tracks': args.tracks, 'notes': args.notes,
+            'channels': args.channels, 'seed': args.seed,
+            'time_signatures': ['{}/{}'.format(*signature)
+                for signature in args.time_signatures]}
+        files = generate_corpus(directory, args.tracks, args.notes,
+            args.channels, args.seed, args.time_signatures)
+
+        report = {'commit': get_commit(), 'config': config, 'stages': {}}
+        for stage in args.stages.split(','):
+            results = Queue()
+            process = Process(target=run_stage,
+                args=(stage, directory, files, results))
+            process.start()
+            process.join()
+            if results.empty():
+                report['stages'][stage] = {'failed': process.exitcode}
+            else:
+                report['stages'][stage] = results.get()
+            print stage, json.dumps(report['stages'][stage], sort_keys=True)
+    finally:
+        rmtree(directory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import numpy as np
+
+from config import *
+from notecache import load_midi_data
+from fpdb import load_variant_db
+from melody import get_database_names, get_index_name, get_variants, \
+    notes_fingerprints
+from pitches import score_batch, score_variants
+from nnmodel import Model
+from os.path import isfile
+
+# Classifies MIDI files against the training databases built by melody.py,
+# for server.py and the classify command of genre_classifier.py. If
+# nn_genres.py has saved a model, its genre probabilities are computed from
+# the scores with NumPy alone, so neither TensorFlow nor matplotlib is ever
+# imported.
+
+# the classifier of this process, see get_classifier
+CLASSIFIER = None
+
+class Classifier():
+    """
+    Classifies MIDI files against every melody database.
+
+    === Attributes ===
+    @param VariantDB index: the training databases of every (hash function,
+        setting)
+    @param Model model: the trained genre model, or None if there isn't one
+    @param list[int] model_columns: the index in a feature row of each
+        column of the model
+    """
+
+    def __init__(self):
+        """
+        Creates a classifier, loading every melody database and the genre
+        model if one was saved.
+
+        @rtype: None
+        """
+        self.index = load_variant_db(get_index_name(), get_database_names())
+        if self.index is None:
+            raise IOError('missing melody databases, run melody.py first')
+
+        self.model = None
+        if isfile(MODEL_FILE):
+            self.model = Model.load(MODEL_FILE)
+
+            # the model names its columns after the training feature files
+            names = [get_feature_name(h, setting)
+                for h, setting in get_variants()]
+            missing = [c for c in self.model.columns if c not in names]
+            if missing:
+                raise ValueError('the model in {} uses features the server '
+                    'does not compute: {}'.format(MODEL_FILE, missing))
+            self.model_columns = [names.index(c) for c in self.model.columns]
+
+    def parse(self, content, file_name=None):
+        """
+        Return the notes of a MIDI file.
+
+        @param Classifier self: this classifier
+        @param str content: the raw bytes of the MIDI file
+        @param str file_name: the path of the MIDI file, if it is on disk
+        @rtype: numpy.ndarray
+        """
+        return load_midi_data(content, file_name).notes(unit='ticks')
+
+    def fingerprint(self, notes):
+        """
+        Return the fingerprints of the notes of a MIDI file for every (hash
+        function, setting).
+
+        @param Classifier self: this classifier
+        @param numpy.ndarray notes: notes in the madmom library format
+        @rtype: dict(tuple: numpy.ndarray)
+        """
+        return notes_fingerprints('upload', notes)
+
+    def classify(self, content, file_name=None):
+        """
+        Return the get_classical score of a MIDI file against every database,
+        as a dict keyed by database name, along with the feature row (the
+        scores in the column order of the melody feature files).
+
+        @param Classifier self: this classifier
+        @param str content: the raw bytes of the MIDI file
+        @param str file_name: the path of the MIDI file, if it is on disk
+        @rtype: dict
+        """
+        fingerprints = self.fingerprint(self.parse(content, file_name))
+
+        # every database is matched at once, see pitches.score_variants
+        return self.get_result(score_variants(self.index, fingerprints))
+
+    def classify_batch(self, batch):
+        """
+        Return the classify results of a batch of fingerprinted MIDI files.
+        The fingerprints of the whole batch are matched at once, and the
+        genre model predicts the whole batch at once.
+
+        @param Classifier self: this classifier
+        @param list[dict(tuple: numpy.ndarray)] batch: the fingerprints of
+            each MIDI file, as returned by fingerprint
+        @rtype: list[dict]
+        """
+        results = [self.get_result(genres)
+            for genres in score_batch(self.index, batch)]
+        self.predict(results)
+        return results
+
+    def get_result(self, genres):
+        """
+        Return the result of classify for the genre scores of a MIDI file
+        against every database.
+
+        @param Classifier self: this classifier
+        @param dict(tuple: dict(str: int)) genres: the genre scores of each
+            (hash function, setting)
+        @rtype: dict
+        """
+        scores = {}
+        features = []
+        for h, setting in get_variants():
+            score = get_classical(genres[(h, setting)])
+            scores['melody_hash{}-{}'.format(h, setting)] = score
+            features.append(score)
+
+        return {'scores': scores, 'features': features}
+
+    def predict(self, results):
+        """
+        Add the genre probabilities of the model to a batch of classify
+        results, with a single prediction for the whole batch.
+
+        @param Classifier self: this classifier
+        @param list[dict] results: the results of classify
+        @rtype: None
+        """
+        if self.model is None or not results:
+            return
+
+        rows = np.array([result['features'] for result in results])
+        rows = rows[:,self.model_columns]
+
+        for result, probabilities in zip(results, self.model.predict(rows)):
+            result['probabilities'] = dict(zip(self.model.genres,
+                probabilities.tolist()))
+            result['genre'] = self.model.genres[probabilities.argmax()]
+
+def get_feature_name(h, setting):
+    # the name nn_genres.py gives the column of a melody feature
+    return 'melody_features{}:{}'.format(h, setting)
+
+def get_classifier():
+    """
+    Return the classifier of this process, loading it on first use. Worker
+    processes forked after it is loaded share its database.
+
+    @rtype: Classifier
+    """
+    global CLASSIFIER
+    if CLASSIFIER is None:
+        CLASSIFIER = Classifier()
+    return CLASSIFIER
+
+def classify_file(path):
+    """
+    Classify the MIDI file at path with the classifier of this process, for
+    map_tracks. A file that cannot be classified gets an error instead of
+    scores, so that it does not stop the rest of a batch.
+
+    @param str path: the path of the MIDI file
+    @rtype: dict
+    """
+    result = {'file': path}
+    try:
+        classifier = get_classifier()
+        with open(path, 'rb') as f:
+            result.update(classifier.classify(f.read(), path))
+        classifier.predict([result])
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return result
@@ -1,8 +1,13 @@
 import numpy as np
+import profiling
 
 from warnings import filterwarnings
-from madmom.utils.midi import *
 from collections import OrderedDict
+from csv import writer as writer_of
+from multiprocessing import Pool
+from os.path import isfile
+from notecache import load_midi
+from profiling import profiled
 
 ONSET = 0
 PITCH = 1
@@ -11,14 +16,28 @@ VELOCITY = 3
 CHANNEL = 4
 
 FAN_FACTOR = 5
+TOP_MOST_FREQUENT = 1
 # MELODY_FEATURES = 5
 
 GENRES = ['classical', 'rock']
 SEPARATOR = ','
 # MELODY_FEATURES = 'features/melody_features.csv'
-PITCH_FEATURES = 'features/pitch_features.csv'
+PITCH_FEATURES = 'features/pitch_features'
 LABELS_FILE = 'labels.csv'
 LABELS_FILE_TEST = 'labels_test.csv'
+MODEL_FILE = 'nn_model.npz'
+
+# feature tables are saved as NumPy archives, optionally with a CSV dump
+FEATURE_EXT = '.npz'
+CSV_EXT = '.csv'
+
+# number of worker processes used to build training databases
+JOBS = 1
+
+# what get_classical scores tracks by: 'matches' counts every hash match of
+# each genre, 'aligned' only the matches of each training track that share
+# its most common time offset with the sample (see pitches.align_genres)
+SCORING = 'matches'
 
 # https://docs.python.org/2/library/collections.html#collections.OrderedDict
 class LastUpdatedOrderedDict(OrderedDict):
@@ -50,13 +69,11 @@ def get_ticks_per_bar(midi, file):
 
     # find time signature numerator, only works for type 1 midi files
     # for type 1 midi, each channel (voice) is contained in its own track
-    events = midi.tracks[0].events
-    event_index = find_event(events, TimeSignatureEvent)
-    if event_index == None:
+    if midi.time_signature == None:
         print 'Time Signature not found for {}'.format(file)
         return None
 
-    beats_per_bar = events[event_index].data[ONSET]
+    beats_per_bar = midi.time_signature[ONSET]
     return beats_per_bar * midi.resolution
 
 def find_event(events, event_type):
@@ -66,11 +83,136 @@ def find_event(events, event_type):
     return None
 
 def get_notes(file):
-    midi = MIDIFile.from_file(file)
+    midi = load_midi(file)
     return midi.notes(unit='ticks')
 
-def export_table(table, csv):
-    file = open(csv, 'w')
-    for value_list in table.values():
-        row = SEPARATOR.join(map(str, value_list)) + '\n'
-        file.write(row)
+@profiled('export_table')
+def export_table(table, name, dump_csv=False, signature=''):
+    """
+    Save a feature table (a dict of track name: feature values) as name plus
+    FEATURE_EXT, holding the track names, a matrix with a row of values per
+    track and the signature of the data the table was computed from. If
+    dump_csv is set, the table is also written to name plus CSV_EXT, one row
+    per track starting with its name.
+
+    @param dict(str: list[float]) table: the features of each track
+    @param str name: the path of the table, without extension
+    @param bool dump_csv: whether to also write a CSV dump
+    @param str signature: identifies the data the table was computed from
+    @rtype: None
+    """
+    names = np.array(table.keys(), dtype=np.str_)
+    if len(table) == 0:
+        # no tracks, so no number of features either
+        values = np.empty((0, 0), dtype=np.float64)
+    else:
+        values = np.array(table.values(), dtype=np.float64).reshape(
+            len(table), -1)
+    np.savez(name + FEATURE_EXT, names=names, values=values,
+        signature=np.array(signature, dtype=np.str_))
+
+    if dump_csv:
+        with open(name + CSV_EXT, 'wb') as file:
+            writer = writer_of(file, delimiter=SEPARATOR, lineterminator='\n')
+            for track, value_list in table.items():
+                writer.writerow([track] + map(str, value_list))
+
+def has_table(name, signature=None):
+    """
+    Return whether a feature table called name (a path without extension)
+    was saved, in either format. If signature is given, the table must also
+    have been computed from the data it identifies, which only tables saved
+    as FEATURE_EXT record.
+
+    @param str name: the path of the table, without extension
+    @param str signature: identifies the data the table must be computed from
+    @rtype: bool
+    """
+    if signature is None:
+        return isfile(name + FEATURE_EXT) or isfile(name + CSV_EXT)
+
+    if not isfile(name + FEATURE_EXT):
+        return False
+    with np.load(name + FEATURE_EXT) as data:
+        return 'signature' in data.files and \
+            str(data['signature']) == signature
+
+def get_flag(args, flag):
+    """
+    Remove flag from the command line arguments and return whether it was
+    given.
+
+    @param list[str] args: the command line arguments
+    @param str flag: the flag, such as --csv
+    @rtype: bool
+    """
+    if flag not in args:
+        return False
+    args.remove(flag)
+    return True
+
+def get_jobs(args):
+    """
+    Remove a --jobs N option from the command line arguments and return N,
+    or JOBS if the option is not given.
+
+    @param list[str] args: the command line arguments
+    @rtype: int
+    """
+    return get_option(args, '--jobs', JOBS, int)
+
+def get_option(args, option, default, convert=str):
+    """
+    Remove an option and its value from the command line arguments and
+    return the value, converted with convert, or default if the option is
+    not given.
+
+    @param list[str] args: the command line arguments
+    @param str option: the option, such as --jobs
+    @param object default: the value if the option is not given
+    @param function convert: the function converting the value
+    @rtype: object
+    """
+    if option not in args:
+        return default
+    i = args.index(option)
+    value = convert(args[i+1])
+    del args[i:i+2]
+    return value
+
+def map_tracks(function, tasks, jobs=JOBS, ordered=True):
+    """
+    Yield function(task) for each task, in order. With more than one job the
+    tasks are spread over a pool of worker processes, so function and tasks
+    must be picklable. If ordered is not set, results are yielded as soon as
+    they are computed, in whatever order the workers finish them.
+
+    @param function function: the function applied to each task
+    @param list tasks: the tasks, usually one per MIDI file
+    @param int jobs: the number of worker processes
+    @param bool ordered: whether to yield results in the order of tasks
+    @rtype: generator
+    """
+    if jobs <= 1:
+        for task in tasks:
+            yield function(task)
+        return
+
+    # the stages timed by the workers are sent back with each result
+    profile = profiling.ENABLED
+    if profile:
+        function = profiling.WorkerTask(function)
+
+    pool = Pool(jobs)
+    try:
+        results = pool.imap(function, tasks) if ordered else \
+            pool.imap_unordered(function, tasks)
+        for result in results:
+            if profile:
+                result, stages = result
+                profiling.merge_stages(stages)
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,169 @@
+import numpy as np
+import csv
+
+from os import getpid, listdir, makedirs, rename
+from os.path import basename, getmtime, getsize, isdir, isfile, splitext
+from config import CSV_EXT, FEATURE_EXT, SEPARATOR
+
+# Feature files (features/*, test-features/*) hold the features of each track
+# along with its name, as NumPy archives (see config.export_table) or as CSV
+# files whose rows start with the track's name. A FeatureStore joins every
+# feature file of a directory into one matrix by track name, so files do not
+# need to list their tracks in the same order, and caches the matrix in a
+# binary file that is reused until a feature file changes.
+
+# directory where assembled feature matrices are cached
+CACHE_DIR = 'cache/features'
+
+class FeatureStore():
+    """
+    The feature files of a directory, joined by track name.
+
+    === Attributes ===
+    @param str directory: the directory of the feature files
+    @param list[str] exclude: the names, without extension, of the tables in
+        directory to leave out
+    """
+
+    def __init__(self, directory, exclude=()):
+        """
+        Creates a store for the feature files in directory.
+
+        @rtype: None
+        """
+        self.directory = directory
+        self.exclude = list(exclude)
+
+    def get_files(self):
+        """
+        Return the paths of the feature files of this store, sorted by name.
+        A table saved in both formats is read from its NumPy archive, the CSV
+        file being a dump of it.
+
+        @param FeatureStore self: this store
+        @rtype: list[str]
+        """
+        tables = {}
+        for file in listdir(self.directory):
+            name, ext = splitext(file)
+            if file.startswith('.') or name in self.exclude:
+                continue
+            if ext == FEATURE_EXT or (ext == CSV_EXT and name not in tables):
+                tables[name] = file
+
+        return ['{}/{}'.format(self.directory, tables[name])
+            for name in sorted(tables)]
+
+    def get_signature(self):
+        """
+        Return a string identifying the current state of the feature files.
+
+        @param FeatureStore self: this store
+        @rtype: str
+        """
+        return ';'.join('{}:{}:{}'.format(path, getsize(path), getmtime(path))
+            for path in self.get_files())
+
+    def load(self):
+        """
+        Return the names of the tracks, the joined feature matrix (one row per
+        track) and the name of each of its columns, from the cache if the
+        feature files have not changed since it was written.
+
+        @param FeatureStore self: this store
+        @rtype: (list[str], numpy.ndarray, list[str])
+        """
+        cache_path = '{}/{}.npz'.format(CACHE_DIR,
+            self.directory.strip('/').replace('/', '_'))
+        signature = self.get_signature()
+
+        if isfile(cache_path):
+            with np.load(cache_path) as data:
+                if str(data['signature']) == signature:
+                    return data['names'].tolist(), data['matrix'], \
+                        data['columns'].tolist()
+
+        names, matrix, columns = self.join()
+        if not isdir(CACHE_DIR):
+            try:
+                makedirs(CACHE_DIR)
+            except OSError:
+                # another process created it in the meantime
+                pass
+        tmp_path = '{}.{}.tmp.npz'.format(cache_path[:-len('.npz')], getpid())
+        np.savez(tmp_path, names=np.array(names, dtype=np.str_),
+            matrix=matrix, columns=np.array(columns, dtype=np.str_),
+            signature=np.array(signature))
+        rename(tmp_path, cache_path)
+        return names, matrix, columns
+
+    def join(self):
+        """
+        Read every feature file and join them by track name, in the order of
+        the first file. Raises ValueError if a track is not in every file,
+        such as when only some files were exported again since tracks were
+        named in them, rather than training on part of the tracks.
+
+        @param FeatureStore self: this store
+        @rtype: (list[str], numpy.ndarray, list[str])
+        """
+        tables = [read_table(path) for path in self.get_files()]
+        if not tables:
+            return [], np.empty((0, 0)), []
+
+        names = [name for name in tables[0][0]
+            if all(name in table[2] for table in tables[1:])]
+        missing = ['{}: {} of {} tracks are not in every file'.format(path,
+            len(table[0]) - len(names), len(table[0]))
+            for path, table in zip(self.get_files(), tables)
+            if len(table[0]) != len(names)]
+        if missing or not names:
+            raise ValueError('the feature files of {} do not hold the same '
+                'tracks ({} in common): {}'.format(self.directory,
+                len(names), '; '.join(missing) or 'every file is empty'))
+
+        blocks = []
+        columns = []
+        for path, (_, values, rows) in zip(self.get_files(), tables):
+            blocks.append(values[[rows[name] for name in names]])
+            stem = splitext(basename(path))[0]
+            columns.extend('{}:{}'.format(stem, i)
+                for i in range(values.shape[1]))
+
+        return names, np.hstack(blocks), columns
+
+def read_table(path):
+    """
+    Read a feature file, returning the track names, the feature values and the
+    row of each track name. CSV files written before track names were
+    recorded have their rows named by position ('#0', '#1', ...), so they only
+    join with each other, by position, as they used to.
+
+    @param str path: the path of the feature file
+    @rtype: (list[str], numpy.ndarray, dict(str: int))
+    """
+    if path.endswith(FEATURE_EXT):
+        with np.load(path) as data:
+            names = data['names'].tolist()
+            return names, data['values'], \
+                dict((name, i) for i, name in enumerate(names))
+
+    with open(path, 'rb') as f:
+        rows = [row for row in csv.reader(f, delimiter=SEPARATOR) if row]
+
+    if rows and is_number(rows[0][0]):
+        names = ['#{}'.format(i) for i in range(len(rows))]
+        values = rows
+    else:
+        names = [row[0] for row in rows]
+        values = [row[1:] for row in rows]
+
+    values = np.array(values, dtype=np.float64).reshape(len(rows), -1)
+    return names, values, dict((name, i) for i, name in enumerate(names))
+
+def is_number(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
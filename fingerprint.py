@@ -0,0 +1,417 @@
+import numpy as np
+import hashlib
+
+from numpy.lib.stride_tricks import as_strided
+from config import ONSET, PITCH, FAN_FACTOR, TOP_MOST_FREQUENT, get_option
+from profiling import profiled
+
+# Fingerprints are generated for every peak note (the anchor) paired with the
+# FAN_FACTOR peak notes that follow it. Rather than looping over every
+# (anchor, target) pair, the onsets are viewed as a strided 2-D array with one
+# row per anchor, so that every pair of a track is hashed in a single NumPy
+# expression.
+
+# a fingerprint is a hash, the onset of its anchor note and the track it
+# belongs to (an index into a list of track names)
+FINGERPRINT = np.dtype([
+    ('hash', np.int64),
+    ('onset', np.int64),
+    ('track', np.int32)
+])
+
+# largest onset difference (in ticks) between an anchor and its targets, or
+# None to pair each anchor with its next FAN_FACTOR peak notes however far
+# apart they are
+MAX_GAP = None
+
+# how the parts of a hash are combined into one number: 'decimal' scales each
+# part by a power of ten and adds them up, as the original hash functions
+# did, 'packed' gives each part its own bits (see PACKED_FIELDS). New
+# databases are packed, since decimal hashes collide.
+LAYOUTS = ['decimal', 'packed']
+LAYOUT = 'packed'
+
+# Decimal hashes overlap: (diff * 100 + percentile) cannot tell a 20 tick
+# difference at the 50th percentile from a 19 tick difference at the 150th,
+# and the pitch hashes are negative and grow with the length of the track.
+# A packed hash is a non-negative 64-bit integer with a fixed field for each
+# part, from the lowest bits up:
+#
+#   bits  0-31  delta: the onset difference of the pair, in units of the
+#               config's quantum (in ticks), at most 2**32 - 1
+#   bits 32-38  target: the pitch of the target (or its tenth of the pitch
+#               range), 0 to 127
+#   bits 39-45  anchor: the pitch of the anchor (or its tenth of the pitch
+#               range), 0 to 127
+#   bits 46-52  percentile: where the anchor is in the track, 0 to 100
+#
+# Parts a hash function does not use are 0. Packed hashes use 53 bits, so
+# they are stored in the int64 hash column like any other hash, and unpack
+# splits them back into a PACKED_FIELDS array.
+PACKED_FIELDS = np.dtype([
+    ('delta', np.uint32),
+    ('target', np.uint8),
+    ('anchor', np.uint8),
+    ('percentile', np.uint8)
+])
+PACKED_SHIFTS = [0, 32, 39, 46]
+PACKED_BITS = [32, 7, 7, 7]
+
+# onset difference (in ticks) of one delta unit of packed hashes
+QUANTUM = 1
+
+class FingerprintConfig():
+    """
+    The parameters fingerprints are generated with. Databases built with
+    different parameters hold different hashes, so the name of a database
+    includes the name of its configuration (see get_name).
+
+    === Attributes ===
+    @param int fan_factor: the number of targets paired with each anchor
+    @param int peaks: the number of most frequent pitches whose notes are
+        peaks
+    @param int max_gap: the largest onset difference between an anchor and a
+        target, or None for no limit
+    @param str layout: how the parts of a hash are combined, one of LAYOUTS
+    @param int quantum: the onset difference (in ticks) of one delta unit of
+        packed hashes
+    """
+
+    def __init__(self, fan_factor=FAN_FACTOR, max_gap=MAX_GAP, layout=LAYOUT,
+            quantum=QUANTUM, peaks=TOP_MOST_FREQUENT):
+        """
+        Creates a configuration.
+
+        @rtype: None
+        """
+        if fan_factor < 1:
+            raise ValueError('fan_factor must be at least 1, not {}'.format(
+                fan_factor))
+        if peaks < 1:
+            raise ValueError('peaks must be at least 1, not {}'.format(peaks))
+        if layout not in LAYOUTS:
+            raise ValueError('unknown hash layout {}, expected one of '
+                '{}'.format(layout, LAYOUTS))
+        if quantum < 1:
+            raise ValueError('quantum must be at least 1, not {}'.format(
+                quantum))
+
+        self.fan_factor = fan_factor
+        self.max_gap = max_gap
+        self.layout = layout
+        self.quantum = quantum
+        self.peaks = peaks
+
+    def __repr__(self):
+        """
+        Represents a FingerprintConfig (self) as a string listing the
+        parameters its hashes depend on (the quantum only matters to packed
+        hashes, and a single peak pitch is left out so that databases built
+        before peaks could be set keep their names).
+
+        @param FingerprintConfig self: this configuration
+        @rtype: str
+        """
+        parameters = 'fan_factor={}, max_gap={}, layout={}'.format(
+            self.fan_factor, self.max_gap, self.layout)
+        if self.layout == 'packed':
+            parameters += ', quantum={}'.format(self.quantum)
+        if self.peaks != 1:
+            parameters += ', peaks={}'.format(self.peaks)
+        return 'FingerprintConfig({})'.format(parameters)
+
+    def __eq__(self, other):
+        """
+        Return whether other is a configuration with the same parameters.
+
+        @param FingerprintConfig self: this configuration
+        @param object other: the object to compare with
+        @rtype: bool
+        """
+        return isinstance(other, FingerprintConfig) and \
+            repr(self) == repr(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(repr(self))
+
+    def get_name(self):
+        """
+        Return a short name that identifies the parameters of this
+        configuration, for database file names.
+
+        @param FingerprintConfig self: this configuration
+        @rtype: str
+        """
+        return hashlib.sha1(repr(self)).hexdigest()[:8]
+
+    def is_original(self):
+        """
+        Return whether this configuration generates the fingerprints of the
+        original hash functions, whose databases were saved as pickled
+        tables named without a configuration (see fpdb.load_database).
+
+        @param FingerprintConfig self: this configuration
+        @rtype: bool
+        """
+        return self == FingerprintConfig(fan_factor=self.fan_factor,
+            max_gap=None, layout='decimal', peaks=1)
+
+def get_config(args):
+    """
+    Remove the fingerprint options (--max-gap N, --quantum N, --layout L and
+    --peaks N) from the command line arguments and return the configuration
+    they give, with the defaults for the options that are not given.
+
+    @param list[str] args: the command line arguments
+    @rtype: FingerprintConfig
+    """
+    return FingerprintConfig(max_gap=get_option(args, '--max-gap', MAX_GAP, int),
+        layout=get_option(args, '--layout', LAYOUT),
+        quantum=get_option(args, '--quantum', QUANTUM, int),
+        peaks=get_option(args, '--peaks', TOP_MOST_FREQUENT, int))
+
+def windows(values, fan_factor):
+    """
+    Return a read-only strided view of values with one row per anchor note,
+    holding the anchor followed by its fan_factor target notes.
+
+    As in the original hash functions, the last fan_factor + 1 notes are never
+    used as anchors.
+
+    @param numpy.ndarray values: one value (onset or pitch) per peak note
+    @param int fan_factor: the number of targets paired with each anchor
+    @rtype: numpy.ndarray
+    """
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    anchors = max(len(values) - (fan_factor + 1), 0)
+    stride = values.strides[0]
+    return as_strided(values, shape=(anchors, fan_factor + 1),
+        strides=(stride, stride), writeable=False)
+
+def to_fingerprints(hashes, onsets, track, targets=None):
+    """
+    Return the structured fingerprint array for a 2-D array of hashes, one row
+    per anchor note. If targets is given, only the pairs it is set for are
+    kept.
+
+    @param numpy.ndarray hashes: hashes of shape (anchors, fan_factor)
+    @param numpy.ndarray onsets: the onset of each anchor note
+    @param int track: the track id of every fingerprint
+    @param numpy.ndarray targets: whether to keep each pair, of the shape of
+        hashes
+    @rtype: numpy.ndarray
+    """
+    onsets = np.repeat(onsets, hashes.shape[1])
+    hashes = hashes.ravel()
+    if targets is not None:
+        onsets = onsets[targets.ravel()]
+        hashes = hashes[targets.ravel()]
+
+    fingerprints = np.empty(hashes.size, dtype=FINGERPRINT)
+    fingerprints['hash'] = hashes
+    fingerprints['onset'] = onsets
+    fingerprints['track'] = track
+    return fingerprints
+
+def get_onsets(notes, config):
+    """
+    Return the windowed onsets of the given notes.
+
+    @param numpy.ndarray notes: peak notes in the madmom library format
+    @param FingerprintConfig config: the fingerprint parameters
+    @rtype: numpy.ndarray
+    """
+    notes = np.asarray(notes, dtype=np.float64).reshape(-1, 5)
+    return windows(notes[:,ONSET], config.fan_factor)
+
+def get_targets(onsets, config):
+    """
+    Return whether each target of the windowed onsets is close enough to its
+    anchor to be paired with it, or None if every target is.
+
+    @param numpy.ndarray onsets: windowed onsets, see get_onsets
+    @param FingerprintConfig config: the fingerprint parameters
+    @rtype: numpy.ndarray
+    """
+    if config.max_gap is None:
+        return None
+    return onsets[:,1:] - onsets[:,:1] <= config.max_gap
+
+def get_pitches(notes, config):
+    """
+    Return the windowed pitches of the given notes.
+
+    @param numpy.ndarray notes: peak notes in the madmom library format
+    @param FingerprintConfig config: the fingerprint parameters
+    @rtype: numpy.ndarray
+    """
+    notes = np.asarray(notes, dtype=np.float64).reshape(-1, 5)
+    return windows(notes[:,PITCH], config.fan_factor)
+
+def get_percentiles(notes, anchors):
+    """
+    Return where each anchor onset is in the track, as a percentile of the
+    onset of its last note. If every note starts at 0, every anchor is at
+    the 0th percentile.
+
+    @param numpy.ndarray notes: peak notes in the madmom library format
+    @param numpy.ndarray anchors: the onset of each anchor
+    @rtype: numpy.ndarray
+    """
+    total_length = np.asarray(notes)[-1][ONSET]
+    if total_length == 0:
+        return np.zeros(np.shape(anchors))
+    return np.trunc(anchors / float(total_length) * 100)
+
+def pack(onsets, config, anchor=0, target=0, percentile=0):
+    """
+    Return the packed hashes (see PACKED_FIELDS) of the windowed onsets, with
+    the given anchor, target and percentile parts, each either an array
+    broadcastable to the pairs or 0. Onset differences too large for the
+    delta field are clipped to its largest value.
+
+    @param numpy.ndarray onsets: windowed onsets, see get_onsets
+    @param FingerprintConfig config: the fingerprint parameters
+    @param numpy.ndarray anchor: the anchor part of each pair
+    @param numpy.ndarray target: the target part of each pair
+    @param numpy.ndarray percentile: the percentile part of each pair
+    @rtype: numpy.ndarray
+    """
+    delta = (onsets[:,1:] - onsets[:,:1]) // config.quantum
+    parts = [delta, target, anchor, percentile]
+
+    hashes = np.zeros(delta.shape, dtype=np.int64)
+    for part, shift, bits in zip(parts, PACKED_SHIFTS, PACKED_BITS):
+        part = np.clip(np.asarray(part, dtype=np.int64), 0, 2 ** bits - 1)
+        hashes |= part << shift
+    return hashes
+
+def unpack(hashes):
+    """
+    Return the parts of packed hashes.
+
+    @param numpy.ndarray hashes: packed hashes
+    @rtype: numpy.ndarray
+    """
+    hashes = np.asarray(hashes, dtype=np.int64)
+    parts = np.empty(hashes.shape, dtype=PACKED_FIELDS)
+    for name, shift, bits in zip(PACKED_FIELDS.names, PACKED_SHIFTS,
+            PACKED_BITS):
+        parts[name] = (hashes >> shift) & (2 ** bits - 1)
+    return parts
+
+@profiled('hash.time_diff')
+def time_diff(notes, track=0, config=None):
+    """
+    Return fingerprints hashed on the difference between the onsets of each
+    peak pair.
+
+    @param numpy.ndarray notes: peak notes in the madmom library format
+    @param int track: the track id of the fingerprints
+    @param FingerprintConfig config: the fingerprint parameters, the
+        defaults if None
+    @rtype: numpy.ndarray
+    """
+    config = config or DEFAULT_CONFIG
+    onsets = get_onsets(notes, config)
+    anchors = onsets[:,:1]
+
+    if config.layout == 'packed':
+        hashes = pack(onsets, config)
+    else:
+        # hash = later offset - earlier offset
+        hashes = onsets[:,1:] - anchors
+    return to_fingerprints(hashes, anchors[:,0], track,
+        get_targets(onsets, config))
+
+@profiled('hash.time_diff_percentile')
+def time_diff_percentile(notes, track=0, config=None):
+    """
+    Return fingerprints hashed on the difference between the onsets of each
+    peak pair and where the pair occurs in the track as a percentile.
+
+    @param numpy.ndarray notes: peak notes in the madmom library format
+    @param int track: the track id of the fingerprints
+    @param FingerprintConfig config: the fingerprint parameters, the
+        defaults if None
+    @rtype: numpy.ndarray
+    """
+    config = config or DEFAULT_CONFIG
+    onsets = get_onsets(notes, config)
+    anchors = onsets[:,:1]
+    if len(anchors) == 0:
+        return np.empty(0, dtype=FINGERPRINT)
+
+    percentile = get_percentiles(notes, anchors)
+    if config.layout == 'packed':
+        hashes = pack(onsets, config, percentile=percentile)
+    else:
+        # hash is of the form onset_diff|percentile
+        # ex: diff = 20, percentile = 50, hash = 2050
+        hashes = (onsets[:,1:] - anchors) * 100 + percentile
+    return to_fingerprints(hashes, anchors[:,0], track,
+        get_targets(onsets, config))
+
+@profiled('hash.time_diff_pitch')
+def time_diff_pitch(notes, track=0, config=None):
+    """
+    Return fingerprints hashed on the onset of each peak pair's target, offset
+    by the onset and pitch of its anchor. Packed hashes hold the difference
+    between the onsets of the pair and the pitches of both notes.
+
+    @param numpy.ndarray notes: peak notes in the madmom library format
+    @param int track: the track id of the fingerprints
+    @param FingerprintConfig config: the fingerprint parameters, the
+        defaults if None
+    @rtype: numpy.ndarray
+    """
+    config = config or DEFAULT_CONFIG
+    onsets = get_onsets(notes, config)
+    anchors = onsets[:,:1]
+    if config.layout == 'packed':
+        pitches = get_pitches(notes, config)
+        hashes = pack(onsets, config, anchor=pitches[:,:1],
+            target=pitches[:,1:])
+    else:
+        pitches = np.asarray(notes, dtype=np.float64).reshape(-1, 5)
+        pitches = pitches[:len(anchors),PITCH][:,np.newaxis]
+        hashes = onsets[:,1:] - anchors * 1000 + pitches
+    return to_fingerprints(hashes, anchors[:,0], track,
+        get_targets(onsets, config))
+
+@profiled('hash.time_diff_pitch_percentile')
+def time_diff_pitch_percentile(notes, track=0, config=None):
+    """
+    Return fingerprints hashed on the onset of each peak pair's target, offset
+    by the onset of its anchor and the anchor's pitch as a tenth of the MIDI
+    pitch range. Packed hashes hold the difference between the onsets of the
+    pair and the pitches of both notes as tenths of the MIDI pitch range.
+
+    @param numpy.ndarray notes: peak notes in the madmom library format
+    @param int track: the track id of the fingerprints
+    @param FingerprintConfig config: the fingerprint parameters, the
+        defaults if None
+    @rtype: numpy.ndarray
+    """
+    config = config or DEFAULT_CONFIG
+    onsets = get_onsets(notes, config)
+    anchors = onsets[:,:1]
+    if config.layout == 'packed':
+        tenths = np.trunc(get_pitches(notes, config) / 127.0 * 10)
+        hashes = pack(onsets, config, anchor=tenths[:,:1],
+            target=tenths[:,1:])
+    else:
+        pitches = np.asarray(notes, dtype=np.float64).reshape(-1, 5)
+        percentile = np.trunc(pitches[:len(anchors),PITCH] / 127.0 * 10)
+        hashes = onsets[:,1:] - anchors * 10 + percentile[:,np.newaxis]
+    return to_fingerprints(hashes, anchors[:,0], track,
+        get_targets(onsets, config))
+
+DEFAULT_CONFIG = FingerprintConfig()
+
+# fingerprint functions, in the order of melody.H_FUNCTIONS
+HASH_FUNCTIONS = [time_diff, time_diff_percentile, time_diff_pitch,
+    time_diff_pitch_percentile]
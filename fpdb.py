@@ -0,0 +1,791 @@
+import numpy as np
+import hashlib
+import pickle
+
+from os import makedirs, rename
+from os.path import getmtime, getsize, isdir, isfile
+from shutil import rmtree
+from config import GENRES
+from fingerprint import FINGERPRINT
+
+# The training databases used to be pickled dicts mapping each hash to a list
+# of PeakPair objects, which are slow to unpickle and large on disk. A
+# FingerprintDB stores the same postings as parallel NumPy columns sorted by
+# hash, so a hash lookup is a binary search and a saved database can be
+# memory-mapped instead of read.
+
+# extension of database directories, one .npy file per column
+DB_EXT = '.db'
+
+# extension of the legacy pickled hash tables
+TABLE_EXT = '.p'
+
+COLUMNS = ['hash', 'onset', 'track', 'genre']
+
+# Each database also records the content hash and modification time of the
+# file every track was fingerprinted from, so that when the corpus changes
+# only the added, removed or modified tracks are fingerprinted again (see
+# get_changes and FingerprintDB.update).
+
+class FingerprintDB():
+    """
+    A database of fingerprints sorted by hash.
+
+    === Attributes ===
+    @param numpy.ndarray hashes: the hash of each fingerprint, sorted
+    @param numpy.ndarray onsets: the anchor onset of each fingerprint
+    @param numpy.ndarray tracks: the track id of each fingerprint
+    @param numpy.ndarray genres: the genre id of each fingerprint
+    @param list[str] track_names: the file name of each track id
+    @param numpy.ndarray track_genres: the genre id of each track id
+    @param list[str] genre_names: the genre of each genre id
+    @param list[str] track_keys: the content hash of each track id's file,
+        or '' if unknown
+    @param numpy.ndarray track_mtimes: the modification time of each track
+        id's file when it was fingerprinted
+    """
+
+    def __init__(self, hashes, onsets, tracks, genres, track_names,
+            track_genres, genre_names=GENRES, track_keys=None,
+            track_mtimes=None):
+        """
+        Creates a database from columns that are already sorted by hash.
+        Tracks without a recorded file state are treated as out of date.
+
+        @rtype: None
+        """
+        if track_keys is None:
+            track_keys = [''] * len(track_names)
+        if track_mtimes is None:
+            track_mtimes = np.zeros(len(track_names))
+
+        self.hashes = hashes
+        self.onsets = onsets
+        self.tracks = tracks
+        self.genres = genres
+        self.track_names = list(track_names)
+        self.track_genres = np.asarray(track_genres, dtype=np.int8)
+        self.genre_names = list(genre_names)
+        self.track_keys = list(track_keys)
+        self.track_mtimes = np.array(track_mtimes, dtype=np.float64)
+
+        # computed on first use, see count_genres and count_repeats
+        self.genre_counts = None
+        self.track_repeats = None
+
+    def __len__(self):
+        """
+        Return the number of fingerprints in this database.
+
+        @param FingerprintDB self: this database
+        @rtype: int
+        """
+        return len(self.hashes)
+
+    def __contains__(self, h):
+        """
+        Return whether the hash h occurs in this database.
+
+        @param FingerprintDB self: this database
+        @param int h: a fingerprint hash
+        @rtype: bool
+        """
+        start, end = self.lookup(h)
+        return start != end
+
+    def lookup(self, h):
+        """
+        Return the range of rows whose hash is h.
+
+        @param FingerprintDB self: this database
+        @param int h: a fingerprint hash
+        @rtype: (int, int)
+        """
+        start = np.searchsorted(self.hashes, h, side='left')
+        end = np.searchsorted(self.hashes, h, side='right')
+        return int(start), int(end)
+
+    def count_genres(self, starts, ends):
+        """
+        Return the number of fingerprints of each genre id in each range of
+        rows, one row of counts per range, without reading the rows.
+
+        @param FingerprintDB self: this database
+        @param numpy.ndarray starts: the first row of each range
+        @param numpy.ndarray ends: the row after the last of each range
+        @rtype: numpy.ndarray
+        """
+        if self.genre_counts is None:
+            self.genre_counts = get_genre_counts(np.asarray(self.genres),
+                len(self.genre_names))
+        return self.genre_counts[ends] - self.genre_counts[starts]
+
+    def count_repeats(self):
+        """
+        Return the largest number of fingerprints of each track id that share
+        both their hash and their onset.
+
+        @param FingerprintDB self: this database
+        @rtype: numpy.ndarray
+        """
+        if self.track_repeats is None:
+            self.track_repeats = get_track_repeats(self.hashes, self.onsets,
+                self.tracks, len(self.track_names))
+        return self.track_repeats
+
+    def genres_of(self, tracks):
+        """
+        Return the genre id of each of the given track ids.
+
+        @param FingerprintDB self: this database
+        @param numpy.ndarray tracks: track ids
+        @rtype: numpy.ndarray
+        """
+        return self.track_genres[tracks]
+
+    def update(self, removed, builder):
+        """
+        Return a copy of this database without the tracks whose ids are in
+        removed, and with the tracks of builder added. The postings of the
+        kept tracks stay in their sorted order and the new ones are merged
+        into them, so nothing is sorted from scratch.
+
+        @param FingerprintDB self: this database
+        @param list[int] removed: the ids of the tracks to remove
+        @param Builder builder: the tracks to add
+        @rtype: FingerprintDB
+        """
+        kept_tracks = np.ones(len(self.track_names), dtype=bool)
+        kept_tracks[list(removed)] = False
+        kept = kept_tracks[self.tracks]
+
+        # renumber the kept tracks, then number the new ones after them
+        new_ids = np.cumsum(kept_tracks) - 1
+        added = builder.build()
+        added_tracks = added.tracks + kept_tracks.sum()
+
+        hashes = np.asarray(self.hashes[kept])
+        positions = np.searchsorted(hashes, added.hashes, side='right')
+
+        def merge(column, added_column):
+            return np.insert(np.asarray(column), positions, added_column)
+
+        kept_ids = np.flatnonzero(kept_tracks)
+        return FingerprintDB(merge(hashes, added.hashes),
+            merge(self.onsets[kept], added.onsets),
+            merge(new_ids[self.tracks[kept]].astype(np.int32), added_tracks),
+            merge(self.genres[kept], added.genres),
+            [self.track_names[i] for i in kept_ids] + added.track_names,
+            np.r_[self.track_genres[kept_ids], added.track_genres],
+            self.genre_names,
+            [self.track_keys[i] for i in kept_ids] + added.track_keys,
+            np.r_[self.track_mtimes[kept_ids], added.track_mtimes])
+
+    def save(self, path):
+        """
+        Save this database to the directory path, replacing any database
+        already saved there.
+
+        @param FingerprintDB self: this database
+        @param str path: the database directory
+        @rtype: None
+        """
+        tmp_path = path + '.tmp'
+        if isdir(tmp_path):
+            rmtree(tmp_path)
+        makedirs(tmp_path)
+
+        np.save(tmp_path + '/hash.npy', self.hashes)
+        np.save(tmp_path + '/onset.npy', self.onsets)
+        np.save(tmp_path + '/track.npy', self.tracks)
+        np.save(tmp_path + '/genre.npy', self.genres)
+        np.save(tmp_path + '/track_names.npy', np.array(self.track_names,
+            dtype=np.str_))
+        np.save(tmp_path + '/track_genres.npy', self.track_genres)
+        np.save(tmp_path + '/genre_names.npy', np.array(self.genre_names,
+            dtype=np.str_))
+        np.save(tmp_path + '/track_keys.npy', np.array(self.track_keys,
+            dtype=np.str_))
+        np.save(tmp_path + '/track_mtimes.npy', self.track_mtimes)
+
+        if isdir(path):
+            rmtree(path)
+        rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load the database saved in the directory path. The columns are
+        memory-mapped unless mmap is False.
+
+        @param str path: the database directory
+        @param bool mmap: whether to memory-map the columns
+        @rtype: FingerprintDB
+        """
+        mode = 'r' if mmap else None
+        columns = [np.load('{}/{}.npy'.format(path, c), mmap_mode=mode)
+            for c in COLUMNS]
+        track_names = np.load(path + '/track_names.npy').tolist()
+        track_genres = np.load(path + '/track_genres.npy')
+        genre_names = np.load(path + '/genre_names.npy').tolist()
+
+        # databases saved before file states were recorded have none
+        track_keys = track_mtimes = None
+        if isfile(path + '/track_keys.npy'):
+            track_keys = np.load(path + '/track_keys.npy').tolist()
+            track_mtimes = np.load(path + '/track_mtimes.npy')
+
+        return cls(*columns, track_names=track_names,
+            track_genres=track_genres, genre_names=genre_names,
+            track_keys=track_keys, track_mtimes=track_mtimes)
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Convert a legacy hash table (a dict of hash: list of PeakPair) into a
+        database.
+
+        @param dict(int: list[PeakPair]) table: the peak pair database
+        @rtype: FingerprintDB
+        """
+        builder = Builder()
+        track_ids = {}
+        rows = []
+        for h, pairs in table.items():
+            for pair in pairs:
+                if pair.file_name not in track_ids:
+                    track_ids[pair.file_name] = len(builder.track_names)
+                    builder.track_names.append(pair.file_name)
+                    builder.track_genres.append(pair.genre)
+                    builder.track_keys.append('')
+                    builder.track_mtimes.append(0.0)
+                rows.append((h, pair.onset, track_ids[pair.file_name]))
+
+        builder.fingerprints.append(np.array(rows, dtype=FINGERPRINT))
+        return builder.build()
+
+class Builder():
+    """
+    Collects the fingerprints of training tracks into a FingerprintDB.
+
+    === Attributes ===
+    @param list[numpy.ndarray] fingerprints: the fingerprints of each track
+    @param list[str] track_names: the file name of each track id
+    @param list[str] track_genres: the genre of each track id
+    @param list[str] track_keys: the content hash of each track id's file
+    @param list[float] track_mtimes: the modification time of each track
+        id's file
+    """
+
+    def __init__(self):
+        """
+        Creates an empty builder.
+
+        @rtype: None
+        """
+        self.fingerprints = []
+        self.track_names = []
+        self.track_genres = []
+        self.track_keys = []
+        self.track_mtimes = []
+
+    def add_track(self, file, genre, fingerprints, path=None):
+        """
+        Add the fingerprints of a track, assigning it the next track id. If
+        the path of the file is given, its state is recorded so that later
+        updates can tell whether the file changed.
+
+        @param Builder self: this builder
+        @param str file: the name of the file
+        @param str genre: the genre of the file
+        @param numpy.ndarray fingerprints: the fingerprints of the file
+        @param str path: the path of the file
+        @rtype: None
+        """
+        if path is not None:
+            self.track_keys.append(get_file_key(path))
+            self.track_mtimes.append(getmtime(path))
+        else:
+            self.track_keys.append('')
+            self.track_mtimes.append(0.0)
+
+        fingerprints = fingerprints.copy()
+        fingerprints['track'] = len(self.track_names)
+        self.fingerprints.append(fingerprints)
+        self.track_names.append(file)
+        self.track_genres.append(genre)
+
+    def build(self):
+        """
+        Return a database of every track added so far.
+
+        @param Builder self: this builder
+        @rtype: FingerprintDB
+        """
+        if self.fingerprints:
+            fingerprints = np.concatenate(self.fingerprints)
+        else:
+            fingerprints = np.empty(0, dtype=FINGERPRINT)
+
+        # a stable sort keeps the postings of each hash in insertion order
+        order = np.argsort(fingerprints['hash'], kind='mergesort')
+        fingerprints = fingerprints[order]
+
+        genre_ids = np.array([GENRES.index(g) for g in self.track_genres],
+            dtype=np.int8)
+        tracks = fingerprints['track'].copy()
+
+        return FingerprintDB(fingerprints['hash'].copy(),
+            fingerprints['onset'].copy(), tracks, genre_ids[tracks],
+            self.track_names, genre_ids, GENRES, self.track_keys,
+            self.track_mtimes)
+
+class Changes():
+    """
+    The difference between the tracks of a database and the files of the
+    corpus.
+
+    === Attributes ===
+    @param list[int] removed: the ids of tracks whose file was removed or
+        modified
+    @param list[tuple] added: the (file, genre, path) of files that were
+        added or modified, which need to be fingerprinted
+    @param dict(int: float) touched: the new modification time of tracks
+        whose file was touched without changing its content
+    """
+
+    def __init__(self):
+        """
+        Creates an empty set of changes.
+
+        @rtype: None
+        """
+        self.removed = []
+        self.added = []
+        self.touched = {}
+
+    def __len__(self):
+        """
+        Return the number of changed tracks.
+
+        @param Changes self: these changes
+        @rtype: int
+        """
+        return len(self.removed) + len(self.added) + len(self.touched)
+
+def get_changes(database, files):
+    """
+    Return the changes needed to bring database up to date with files, a list
+    of (file, genre, path) tuples. A file whose modification time is
+    unchanged is assumed unchanged; otherwise its content hash decides.
+
+    @param FingerprintDB database: the database, or None if there isn't one
+    @param list[tuple] files: the (file, genre, path) of every training file
+    @rtype: Changes
+    """
+    changes = Changes()
+    if database is None:
+        changes.added = list(files)
+        return changes
+
+    known = {}
+    for i, (name, genre) in enumerate(zip(database.track_names,
+            database.track_genres.tolist())):
+        known[(name, database.genre_names[genre])] = i
+
+    for file, genre, path in files:
+        i = known.pop((file, genre), None)
+        if i is None:
+            changes.added.append((file, genre, path))
+        elif getmtime(path) != database.track_mtimes[i]:
+            if get_file_key(path) == database.track_keys[i]:
+                changes.touched[i] = getmtime(path)
+            else:
+                changes.removed.append(i)
+                changes.added.append((file, genre, path))
+
+    changes.removed.extend(known.values())
+    return changes
+
+def update_database(name, database, changes, fingerprints):
+    """
+    Apply changes to the database called name and save it, where fingerprints
+    maps the (file, genre) of each added track to its fingerprints. Return
+    the saved database.
+
+    @param str name: the path of the database, without extension
+    @param FingerprintDB database: the database, or None if there isn't one
+    @param Changes changes: the changes to apply
+    @param dict(tuple: numpy.ndarray) fingerprints: the new fingerprints
+    @rtype: FingerprintDB
+    """
+    builder = Builder()
+    for file, genre, path in changes.added:
+        builder.add_track(file, genre, fingerprints[(file, genre)], path)
+
+    if database is None:
+        database = builder.build()
+    else:
+        for i, mtime in changes.touched.items():
+            database.track_mtimes[i] = mtime
+        database = database.update(changes.removed, builder)
+
+    database.save(name + DB_EXT)
+    return load_database(name)
+
+def get_file_key(path):
+    """
+    Return the content hash of a file.
+
+    @param str path: the path of the file
+    @rtype: str
+    """
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def load_database(name, legacy_name=None):
+    """
+    Load the database called name (a path without extension), converting the
+    legacy pickled hash table called legacy_name if that is all there is.
+    Return None if neither exists.
+
+    @param str name: the path of the database, without extension
+    @param str legacy_name: the path of the pickled hash table holding the
+        same fingerprints, without extension, or None if there is none
+    @rtype: FingerprintDB
+    """
+    if isdir(name + DB_EXT):
+        return FingerprintDB.load(name + DB_EXT)
+
+    if legacy_name is not None and isfile(legacy_name + TABLE_EXT):
+        database = FingerprintDB.from_table(
+            pickle.load(open(legacy_name + TABLE_EXT, 'rb')))
+        database.save(name + DB_EXT)
+        return database
+
+    return None
+
+# Classifying a track means matching its fingerprints against the database
+# of every variant (hash function and setting) of the fingerprints. A
+# VariantDB holds the postings of all of them in one structure: each posting
+# is keyed by the rank of its hash in the sorted hashes of every variant,
+# times the number of variants, plus its variant id. The postings of a hash
+# in one variant are then a single range of the sorted keys, so the
+# fingerprints of every variant of a track are looked up with one binary
+# search. The number of postings of each genre before every row is kept
+# too, so that counting the matches of each genre, all classification needs,
+# takes two reads per fingerprint instead of expanding every posting.
+
+VARIANT_COLUMNS = ['key', 'onset', 'track', 'genre', 'genre_counts']
+
+class VariantDB():
+    """
+    The fingerprints of several variants of the training databases, sorted by
+    (hash, variant).
+
+    === Attributes ===
+    @param numpy.ndarray hashes: every distinct hash, sorted
+    @param numpy.ndarray keys: the key of each fingerprint (the rank of its
+        hash in hashes times the number of variants, plus its variant id),
+        sorted
+    @param numpy.ndarray onsets: the anchor onset of each fingerprint
+    @param numpy.ndarray tracks: the track id of each fingerprint
+    @param numpy.ndarray genres: the genre id of each fingerprint
+    @param numpy.ndarray genre_counts: the number of fingerprints of each
+        genre id before each row, with one more row for the total
+    @param list[tuple] variants: the variant of each variant id
+    @param list[str] track_names: the file name of each track id
+    @param numpy.ndarray track_genres: the genre id of each track id
+    @param list[str] genre_names: the genre of each genre id
+    @param str signature: the state of the databases this was built from
+    """
+
+    def __init__(self, hashes, keys, onsets, tracks, genres, genre_counts,
+            variants, track_names, track_genres, genre_names=GENRES,
+            signature=''):
+        """
+        Creates a database from columns that are already sorted by key.
+
+        @rtype: None
+        """
+        self.hashes = hashes
+        self.keys = keys
+        self.onsets = onsets
+        self.tracks = tracks
+        self.genres = genres
+        self.genre_counts = genre_counts
+        self.variants = [tuple(variant) for variant in variants]
+        self.track_names = list(track_names)
+        self.track_genres = np.asarray(track_genres, dtype=np.int8)
+        self.genre_names = list(genre_names)
+        self.signature = signature
+
+        # computed on first use, see count_repeats
+        self.track_repeats = None
+
+    def __len__(self):
+        """
+        Return the number of fingerprints in this database.
+
+        @param VariantDB self: this database
+        @rtype: int
+        """
+        return len(self.keys)
+
+    def find(self, hashes, variants):
+        """
+        Return the range of rows holding each of the given hashes in the
+        corresponding variant ids.
+
+        @param VariantDB self: this database
+        @param numpy.ndarray hashes: fingerprint hashes
+        @param numpy.ndarray variants: the variant id of each hash
+        @rtype: (numpy.ndarray, numpy.ndarray)
+        """
+        if len(self.hashes) == 0:
+            empty = np.zeros(len(hashes), dtype=np.int64)
+            return empty, empty
+
+        ranks = np.searchsorted(self.hashes, hashes)
+        ranks = np.minimum(ranks, len(self.hashes) - 1)
+        keys = ranks * len(self.variants) + variants
+
+        starts = np.searchsorted(self.keys, keys, side='left')
+        ends = np.searchsorted(self.keys, keys, side='right')
+        missing = np.asarray(self.hashes[ranks]) != hashes
+        ends[missing] = starts[missing]
+        return starts, ends
+
+    def count_genres(self, starts, ends):
+        """
+        Return the number of fingerprints of each genre id in each range of
+        rows, one row of counts per range.
+
+        @param VariantDB self: this database
+        @param numpy.ndarray starts: the first row of each range
+        @param numpy.ndarray ends: the row after the last of each range
+        @rtype: numpy.ndarray
+        """
+        return np.asarray(self.genre_counts[ends]) - \
+            np.asarray(self.genre_counts[starts])
+
+    def count_repeats(self):
+        """
+        Return the largest number of fingerprints of each track id that share
+        both their key and their onset.
+
+        @param VariantDB self: this database
+        @rtype: numpy.ndarray
+        """
+        if self.track_repeats is None:
+            self.track_repeats = get_track_repeats(self.keys, self.onsets,
+                self.tracks, len(self.track_names))
+        return self.track_repeats
+
+    def genres_of(self, tracks):
+        """
+        Return the genre id of each of the given track ids.
+
+        @param VariantDB self: this database
+        @param numpy.ndarray tracks: track ids
+        @rtype: numpy.ndarray
+        """
+        return self.track_genres[tracks]
+
+    def save(self, path):
+        """
+        Save this database to the directory path, replacing any database
+        already saved there.
+
+        @param VariantDB self: this database
+        @param str path: the database directory
+        @rtype: None
+        """
+        tmp_path = path + '.tmp'
+        if isdir(tmp_path):
+            rmtree(tmp_path)
+        makedirs(tmp_path)
+
+        np.save(tmp_path + '/hash.npy', self.hashes)
+        np.save(tmp_path + '/key.npy', self.keys)
+        np.save(tmp_path + '/onset.npy', self.onsets)
+        np.save(tmp_path + '/track.npy', self.tracks)
+        np.save(tmp_path + '/genre.npy', self.genres)
+        np.save(tmp_path + '/genre_counts.npy', self.genre_counts)
+        np.save(tmp_path + '/variants.npy', np.array(self.variants))
+        np.save(tmp_path + '/track_names.npy', np.array(self.track_names,
+            dtype=np.str_))
+        np.save(tmp_path + '/track_genres.npy', self.track_genres)
+        np.save(tmp_path + '/genre_names.npy', np.array(self.genre_names,
+            dtype=np.str_))
+        np.save(tmp_path + '/signature.npy', np.array(self.signature))
+
+        if isdir(path):
+            rmtree(path)
+        rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load the database saved in the directory path. The columns are
+        memory-mapped unless mmap is False.
+
+        @param str path: the database directory
+        @param bool mmap: whether to memory-map the columns
+        @rtype: VariantDB
+        """
+        mode = 'r' if mmap else None
+        hashes = np.load(path + '/hash.npy', mmap_mode=mode)
+        columns = [np.load('{}/{}.npy'.format(path, c), mmap_mode=mode)
+            for c in VARIANT_COLUMNS]
+
+        return cls(hashes, *columns,
+            variants=np.load(path + '/variants.npy').tolist(),
+            track_names=np.load(path + '/track_names.npy').tolist(),
+            track_genres=np.load(path + '/track_genres.npy'),
+            genre_names=np.load(path + '/genre_names.npy').tolist(),
+            signature=str(np.load(path + '/signature.npy')))
+
+    @classmethod
+    def from_databases(cls, databases, variants, signature=''):
+        """
+        Combine the database of each variant into one. The postings of each
+        hash keep their order within each variant, so matching a variant
+        gives the same matches as its own database.
+
+        @param dict(tuple: FingerprintDB) databases: the database of each
+            variant
+        @param list[tuple] variants: the variants, in the order of their ids
+        @param str signature: the state of the databases
+        @rtype: VariantDB
+        """
+        hashes = np.unique(np.concatenate([np.asarray(databases[v].hashes)
+            for v in variants] or [np.empty(0, dtype=np.int64)]))
+
+        # tracks are numbered anew, since each database numbers its own
+        track_ids = {}
+        track_names = []
+        track_genres = []
+        keys = []
+        onsets = []
+        tracks = []
+        for i, variant in enumerate(variants):
+            database = databases[variant]
+            ids = []
+            for name, genre in zip(database.track_names,
+                    database.track_genres.tolist()):
+                track = (name, database.genre_names[genre])
+                if track not in track_ids:
+                    track_ids[track] = len(track_names)
+                    track_names.append(name)
+                    track_genres.append(GENRES.index(track[1]))
+                ids.append(track_ids[track])
+
+            ranks = np.searchsorted(hashes, database.hashes)
+            keys.append(ranks * len(variants) + i)
+            onsets.append(np.asarray(database.onsets))
+            tracks.append(np.array(ids, dtype=np.int32)[database.tracks])
+
+        if variants:
+            keys = np.concatenate(keys)
+            onsets = np.concatenate(onsets)
+            tracks = np.concatenate(tracks)
+        else:
+            keys = onsets = np.empty(0, dtype=np.int64)
+            tracks = np.empty(0, dtype=np.int32)
+
+        # each variant's keys are already sorted, and a stable sort keeps the
+        # postings of each key in their order
+        order = np.argsort(keys, kind='mergesort')
+        track_genres = np.array(track_genres, dtype=np.int8)
+        tracks = tracks[order]
+        genres = track_genres[tracks]
+
+        return cls(hashes, keys[order], onsets[order], tracks, genres,
+            get_genre_counts(genres, len(GENRES)), variants, track_names,
+            track_genres, GENRES, signature)
+
+def get_genre_counts(genres, count):
+    """
+    Return the number of postings of each genre id before each posting, with
+    one more row for the totals, so that the postings of each genre in a
+    range of rows are counted with a subtraction.
+
+    @param numpy.ndarray genres: the genre id of each posting
+    @param int count: the number of genre ids
+    @rtype: numpy.ndarray
+    """
+    genre_counts = np.zeros((len(genres) + 1, count), dtype=np.int32)
+    for genre in range(count):
+        np.cumsum(genres == genre, out=genre_counts[1:,genre])
+    return genre_counts
+
+def get_track_repeats(keys, onsets, tracks, count):
+    """
+    Return the largest number of fingerprints of each of count track ids that
+    share both their key and their onset, given the sorted keys of the
+    fingerprints. A sample fingerprint adds at most that many matches to any
+    one time offset of a track.
+
+    @param numpy.ndarray keys: the sorted key (or hash) of each fingerprint
+    @param numpy.ndarray onsets: the anchor onset of each fingerprint
+    @param numpy.ndarray tracks: the track id of each fingerprint
+    @param int count: the number of track ids
+    @rtype: numpy.ndarray
+    """
+    keys = np.asarray(keys)
+    onsets = np.asarray(onsets)
+    tracks = np.asarray(tracks)
+    order = np.lexsort((onsets, tracks, keys))
+    keys, onsets, tracks = keys[order], onsets[order], tracks[order]
+
+    starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]) |
+        (tracks[1:] != tracks[:-1]) | (onsets[1:] != onsets[:-1])])
+    starts = starts[:len(keys)]
+    lengths = np.diff(np.r_[starts, len(keys)])
+
+    repeats = np.zeros(count, dtype=np.int64)
+    np.maximum.at(repeats, tracks[starts], lengths)
+    return repeats
+
+def get_signature(names):
+    """
+    Return a string identifying the current state of the databases called
+    names.
+
+    @param list[str] names: the paths of the databases, without extension
+    @rtype: str
+    """
+    paths = ['{}{}/hash.npy'.format(name, DB_EXT) for name in names]
+    return ';'.join('{}:{}:{}'.format(path, getsize(path), getmtime(path))
+        for path in paths)
+
+def load_variant_db(name, names, databases=None):
+    """
+    Load the VariantDB called name (a path without extension) holding the
+    database of each variant, where names maps each variant to the name of
+    its database. The combined database is built and saved again if any of
+    them changed since. Return None if one of them does not exist.
+
+    @param str name: the path of the combined database, without extension
+    @param dict(tuple: str) names: the database name of each variant, whose
+        ids follow the sorted order of the variants
+    @param dict(tuple: FingerprintDB) databases: the databases of the
+        variants, if they are already loaded
+    @rtype: VariantDB
+    """
+    variants = sorted(names)
+    if not all(isdir(names[v] + DB_EXT) for v in variants):
+        return None
+
+    signature = get_signature([names[v] for v in variants])
+    if isdir(name + DB_EXT):
+        index = VariantDB.load(name + DB_EXT)
+        if index.signature == signature and index.variants == variants:
+            return index
+
+    if databases is None:
+        databases = dict((v, load_database(names[v])) for v in variants)
+    index = VariantDB.from_databases(databases, variants, signature)
+    index.save(name + DB_EXT)
+    return VariantDB.load(name + DB_EXT)
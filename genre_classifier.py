@@ -0,0 +1,230 @@
+import argparse
+import json
+
+from os import listdir
+from os.path import isfile, join
+from sys import stderr, stdout
+
+# A single entry point for the whole pipeline:
+#
+#   python genre_classifier.py build [--jobs N]
+#   python genre_classifier.py features [--jobs N] [--csv]
+#   python genre_classifier.py classify song.mid [song.mid ...]
+#   python genre_classifier.py batch directory [--jobs N] [--output FILE]
+#   python genre_classifier.py train [--batch-size N] [--validation-split F]
+#       [--patience N]
+#   python genre_classifier.py plot
+#
+# The commands that fingerprint tracks (build, features, classify and batch)
+# take the fingerprint options --max-gap N, --quantum N, --layout L and
+# --peaks N, which select the databases they build or classify against.
+#
+# The commands that score tracks (features, classify and batch) also take
+# --scoring matches|aligned, see config.SCORING.
+#
+# Any command can be profiled with --profile report.json (the time spent in
+# each stage, see profiling.py) or --cprofile stats.prof, given before it.
+#
+# Each command imports only the modules it needs, when it runs, so that
+# classifying a file never imports matplotlib or TensorFlow, which take
+# longer to import than classifying takes.
+
+def configure(args):
+    # fingerprint and score tracks with the parameters given on the command
+    # line
+    import config
+    import melody
+    from fingerprint import FingerprintConfig
+
+    parameters = dict((name, getattr(args, name))
+        for name in ['max_gap', 'layout', 'quantum', 'peaks']
+        if getattr(args, name) is not None)
+    melody.CONFIG = FingerprintConfig(**parameters)
+    if getattr(args, 'scoring', None):
+        config.SCORING = args.scoring
+
+def build(args):
+    # update the melody databases with the training set
+    from config import load_settings
+    from melody import build
+
+    load_settings()
+    configure(args)
+    build(args.jobs)
+
+def features(args):
+    # update the melody databases, then export the melody and test features
+    from config import load_settings
+    from melody import export_features
+
+    load_settings()
+    configure(args)
+    export_features(args.jobs, args.csv)
+
+def classify(args):
+    # print the classification of each file as a line of JSON
+    from config import load_settings
+    from classifier import classify_file, get_classifier
+
+    load_settings()
+    configure(args)
+    get_classifier()
+    for file in args.files:
+        print json.dumps(classify_file(file), sort_keys=True)
+
+def batch(args):
+    # classify every file of a directory over a pool of worker processes,
+    # writing each result as a line of JSON as soon as it is computed. Files
+    # already classified in the output file are skipped, so an interrupted
+    # batch resumes where it stopped.
+    from config import load_settings, map_tracks
+    from classifier import classify_file, get_classifier
+
+    load_settings()
+    configure(args)
+    files = [join(args.directory, file)
+        for file in sorted(listdir(args.directory))
+        if not file.startswith('.') and isfile(join(args.directory, file))]
+
+    done = get_classified(args.output) if args.output else set()
+    files = [file for file in files if file not in done]
+    stderr.write('{} files to classify, {} already classified\n'.format(
+        len(files), len(done)))
+    if not files:
+        return
+
+    # load the databases before forking, so that the workers share them
+    get_classifier()
+
+    output = open(args.output, 'a') if args.output else stdout
+    try:
+        for i, result in enumerate(map_tracks(classify_file, files, args.jobs,
+                ordered=False)):
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+            output.flush()
+            stderr.write('[{}/{}] {}{}\n'.format(i + 1, len(files),
+                result['file'], ' (error)' if 'error' in result else ''))
+    finally:
+        if output is not stdout:
+            output.close()
+
+def get_classified(path):
+    # return the files that have a result in the JSON lines file at path.
+    # Files whose result is an error are classified again, and a line cut
+    # short by an interruption is ignored (and ended, so the next result
+    # starts on its own line).
+    done = set()
+    if not isfile(path):
+        return done
+
+    with open(path, 'r+') as f:
+        lines = f.read().split('\n')
+        if lines[-1]:
+            f.write('\n')
+
+    for line in lines:
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        if 'error' not in result:
+            done.add(result['file'])
+    return done
+
+def train(args):
+    # train the genre model on the exported features and save it
+    import nn_genres
+    nn_genres.main(args.batch_size, args.validation_split, args.patience)
+
+def plot(args):
+    # draw the amplitude histogram of every training track
+    import amplitude
+    amplitude.main()
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='genre_classifier.py',
+        description='classify MIDI files by genre')
+    parser.add_argument('--profile', metavar='FILE',
+        help='write the time spent in each stage to FILE, as JSON')
+    parser.add_argument('--cprofile', metavar='FILE',
+        help='profile the command with cProfile, writing its statistics '
+            'to FILE')
+    commands = parser.add_subparsers(title='commands')
+
+    # the defaults are those of fingerprint.py, which is only imported by
+    # the commands that fingerprint tracks
+    fingerprints = argparse.ArgumentParser(add_help=False)
+    options = fingerprints.add_argument_group('fingerprint options')
+    options.add_argument('--max-gap', type=int, metavar='N',
+        help='largest onset difference in ticks between the notes of a '
+            'fingerprint (default: no limit)')
+    options.add_argument('--layout', choices=['decimal', 'packed'],
+        help='how the parts of a hash are combined (default: packed)')
+    options.add_argument('--quantum', type=int, metavar='N',
+        help='ticks per onset difference unit of packed hashes (default: 1)')
+    options.add_argument('--peaks', type=int, metavar='N',
+        help='number of most frequent pitches whose notes are fingerprinted '
+            '(default: 1)')
+
+    scores = argparse.ArgumentParser(add_help=False)
+    scores.add_argument('--scoring', choices=['matches', 'aligned'],
+        help='count every hash match of each genre, or only the time-aligned '
+            'matches of each training track (default: matches)')
+
+    command = commands.add_parser('build', parents=[fingerprints],
+        help='update the training databases')
+    command.add_argument('--jobs', type=int, default=1,
+        help='number of worker processes')
+    command.set_defaults(run=build)
+
+    command = commands.add_parser('features',
+        parents=[fingerprints, scores],
+        help='update the databases and export the feature tables')
+    command.add_argument('--jobs', type=int, default=1,
+        help='number of worker processes')
+    command.add_argument('--csv', action='store_true',
+        help='also write the feature tables as CSV')
+    command.set_defaults(run=features)
+
+    command = commands.add_parser('classify',
+        parents=[fingerprints, scores],
+        help='classify MIDI files')
+    command.add_argument('files', nargs='+', metavar='file')
+    command.set_defaults(run=classify)
+
+    command = commands.add_parser('batch', parents=[fingerprints, scores],
+        help='classify every file of a directory in parallel')
+    command.add_argument('directory')
+    command.add_argument('--jobs', type=int, default=1,
+        help='number of worker processes')
+    command.add_argument('--output', metavar='FILE',
+        help='append the results to FILE, skipping the files it already '
+            'has results for (default: standard output)')
+    command.set_defaults(run=batch)
+
+    # the defaults of nn_genres.py, which is only imported to train
+    command = commands.add_parser('train', help='train the genre model')
+    command.add_argument('--batch-size', type=int, default=32,
+        help='rows per gradient step, 0 for every row at once')
+    command.add_argument('--validation-split', type=float, default=0.2,
+        help='fraction of the tracks held out for early stopping, 0 to '
+            'train for every epoch')
+    command.add_argument('--patience', type=int, default=50,
+        help='epochs without a better validation loss before stopping')
+    command.set_defaults(run=train)
+
+    command = commands.add_parser('plot',
+        help='plot the amplitudes of the training tracks')
+    command.set_defaults(run=plot)
+
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    if args.profile or args.cprofile:
+        from profiling import enable
+        enable(args.profile, args.cprofile)
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
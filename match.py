@@ -4,7 +4,9 @@ import pickle
 import pprint
 import warnings
 
-from madmom.utils.midi import *
+from notecache import load_midi
+from barindex import BarIndex, load_index
+from profiling import profiled
 from os import listdir
 from populate import *
 
@@ -18,7 +20,10 @@ ONSET = 2
 def main():
     warnings.filterwarnings('ignore')
 
-    master_table = pickle.load(open("table.p", "rb"))
+    master_table = load_index()
+    if master_table is None:
+        print "no table found, run populate.py first"
+        return
 
     for file in listdir('test-set'):
         if not file.startswith('.'):
@@ -31,8 +36,13 @@ def main():
             print(file)
             print(percentages)
 
+@profiled('match_bars')
 def midi_classify(file, master_table):
-    midi = MIDIFile.from_file(file)
+    # master_table is a BarIndex, or a table dict as built by populate.py
+    if isinstance(master_table, dict):
+        master_table = BarIndex.from_table(master_table)
+
+    midi = load_midi(file)
     notes = midi.notes(unit='ticks')
 
     ticks_per_bar = get_ticks_per_bar(midi, notes, file)
@@ -46,27 +56,19 @@ def midi_classify(file, master_table):
     # use time intervals as dictionary keys
     interval = 1
 
-    prev_highest, prev_onset, cursor = get_highest(notes, 0, ticks_per_bar)
-
-    while cursor < len(notes) - 1:
-        highest, onset, cursor_moved_by = get_highest(notes, cursor, ticks_per_bar)
-        # time_gap = onset - prev_onset
+    bar_highest, _ = get_bar_highest(notes, ticks_per_bar)
+    m = []
 
+    for prev_highest, highest in zip(bar_highest[:-1],
+            bar_highest[1:]):
         # compare current highest note with previous highest note
-        if prev_highest in master_table.keys() and highest in master_table.keys():
-            m = []
-
-            for x in master_table[prev_highest]:
-                for y in master_table[highest]:
-                    if x[TITLE] == y[TITLE]:
-                        if 0 <= y[ONSET] - x[ONSET] - 1 <= ONSET_TOLERANCE:
-                            m.append((x[TITLE], x[GENRE]))
+        # as before, a pair with a pitch that is not in the table repeats the
+        # matches of the previous pair
+        if prev_highest in master_table and highest in master_table:
+            m = master_table.find_consecutive(prev_highest, highest,
+                ONSET_TOLERANCE)
 
         matches[interval] = m
-
-        prev_highest = highest
-        prev_onset = onset
-        cursor += cursor_moved_by
         interval += 1
 
     return matches
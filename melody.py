@@ -1,9 +1,13 @@
 import numpy as np
-import pickle
+import config
+import fingerprint
 
 from config import *
 from os import listdir
-from madmom.utils.midi import MIDIFile
+from sys import argv
+from notecache import load_midi
+from fpdb import get_changes, load_database, load_variant_db, update_database
+from profiling import profiled
 from pprint import pprint
 from pitches import *
 
@@ -11,6 +15,12 @@ CONSEC_DENOMS = 5
 MAX_ONSET = 1000    # assume after 3 seconds, melody has finished
 SETTINGS = 5
 
+# the parameters every melody database is fingerprinted with
+CONFIG = fingerprint.FingerprintConfig()
+
+H_FUNCTIONS = [hash_time_diff, hash_time_diff_percentile, hash_time_diff_pitch,\
+    hash_time_diff_pitch_percentile]
+
 class Track():
     def __init__(self, name):
         self.name = name
@@ -35,21 +45,15 @@ class Track():
         self.melody_channel = votes[setting]
 
 class Channel():
-    def __init__(self, channel):
+    def __init__(self, channel, onsets, pitches):
+        # onsets and pitches are arrays holding the channel's notes in order
         self.channel = channel
-        self.consecutives = {}
-        self.onsets = []
-        self.pitches = [] 
+        self.onsets = onsets
+        self.pitches = pitches
 
     def __str__(self):
         return "channel {} {} {}".format(self.channel, self.onsets, self.pitches)
 
-    def add_onset(self, onset):
-        self.onsets.append(onset)
-
-    def add_pitch(self, pitch):
-        self.pitches.append(pitch)
-
     def analyze_pitches(self):
         # print "analyzing pitches for channel {}".format(self.channel)
         return round(np.var(self.pitches), 2)
@@ -64,132 +68,178 @@ class Channel():
         onset_diffs = self.get_diffs(self.onsets)
         return round(np.var(onset_diffs), 2)
 
-    def get_diffs(self, lst):
-        # get differences between adjacent list elements
-        diffs = []
-        for i in range(1, len(lst)):
-            diff = lst[i] - lst[i-1]
-            if diff < MAX_ONSET:
-                diffs.append(diff)
-        return diffs
+    def get_diffs(self, values):
+        # get differences between adjacent elements
+        diffs = np.diff(values)
+        return diffs[diffs < MAX_ONSET]
 
     def analyze_consec_pitches(self):
         # print "analyzing consecutive pitches for CHANNEL {}".format(self.channel)
-        runs = [0]
+
+        # runs of equal differences between pitches c notes apart, for each
+        # of the c interleaved sequences. All runs and ratios share one list,
+        # of which only the maximum and the last value (which the next run of
+        # equal differences extends) matter, so only those are kept.
+        longest = 0
+        last = 0
+        n = len(self.pitches)
         for c in range(1, CONSEC_DENOMS + 1):
-            pattern_frequency = {}
-            all_runs = {}
             for i in range(c):
-                diffs = []
-                for j in range(0, len(self.pitches) - c, c):
-                    diff = self.pitches[i+j] - self.pitches[i+j-c]
-                    if len(diffs) > 0:
-                        if diff == diffs[-1]:
-                            runs[-1] += 1
-                        else:
-                            runs.append(0)
-                    diffs.append(diff)
+                # the first difference wraps around to the end of the channel
+                positions = np.arange(i, n - c + i, c)
+                diffs = self.pitches[positions] - self.pitches[positions - c]
+                if len(diffs) == 0:
+                    continue
+
+                # lengths of the runs of equal consecutive differences
+                changes = np.flatnonzero(diffs[1:] != diffs[:-1]) + 1
+                lengths = np.diff(np.r_[0, changes, len(diffs)])
+
+                last = add_ones(last, lengths[0] - 1)
+                longest = max(longest, last)
+                if len(lengths) > 1:
+                    longest = max(longest, int(lengths[1:].max()) - 1)
+                    last = int(lengths[-1]) - 1
+
                 # count most occurring difference
-                if diffs:
-                    runs.append(round(max(runs) / float(len(diffs)), 2))
+                last = round(longest / float(len(diffs)), 2)
+                longest = max(longest, last)
 
-        return (max(runs), len(self.pitches))
+        return (longest, n)
+
+def add_ones(value, times):
+    # add 1 to value, times times. A float is incremented one step at a time
+    # (np.add.accumulate is sequential) so that it rounds exactly like
+    # repeated += 1 does.
+    if not isinstance(value, float):
+        return value + int(times)
+    return float(np.add.accumulate(np.r_[value, np.ones(times)])[-1])
 
 def main():
+    global CONFIG
 
     load_settings()
-
-    global H_FUNCTIONS
-    H_FUNCTIONS = [hash_time_diff, hash_time_diff_percentile, hash_time_diff_pitch,\
-    hash_time_diff_pitch_percentile]
-
-    features = LastUpdatedOrderedDict()
-
-    # build hashes
-    for h in range(len(H_FUNCTIONS)):
-        for setting in range(SETTINGS):
-
-            training_hashes = {}
-            hash_file = 'melody_hash{}-{}.p'.format(h, setting)
-            hash_file_path = 'pickles/' + hash_file
-
-            # build hashes from training set
-            if hash_file not in listdir('pickles'):
-                for genre in GENRES:
-                    for file in listdir('midi-' + genre):
-                        if not file.startswith('.'):
-                            file_name = 'midi-' + genre + '/' + file
-                            print "building hashes {} for {} with setting {}".format(h, file_name, setting)
-                            track = Track(file)
-                            notes = get_notes(file_name)
-                            analyze_voices(notes, track, setting)
-                            build_hashes(h, file, genre, training_hashes, track)
-
-                pickle.dump(training_hashes, open(hash_file_path, "wb"))
+    jobs = get_jobs(argv)
+    dump_csv = get_flag(argv, '--csv')
+    CONFIG = fingerprint.get_config(argv)
+    config.SCORING = get_option(argv, '--scoring', config.SCORING)
+    export_features(jobs, dump_csv)
+
+def build(jobs=JOBS):
+    # bring every database up to date with the training set, returning the
+    # databases, the training tasks and the fingerprints of every track that
+    # had to be fingerprinted
+    variants = get_variants()
+    databases = dict((variant, load_database(get_database_name(*variant),
+        get_legacy_name(*variant))) for variant in variants)
+
+    tasks = [(file, genre) for genre in GENRES
+        for file in listdir('midi-' + genre) if not file.startswith('.')]
+
+    # work out which tracks each database is missing or holds stale
+    # fingerprints of
+    files = [(file, genre, get_file_name(file, genre)) for file, genre in tasks]
+    changes = dict((variant, get_changes(databases[variant], files))
+        for variant in variants)
+
+    # fingerprint the tracks that are needed for every hash function and
+    # setting in a single traversal, analyzing their voices only once
+    added = set((file, genre) for c in changes.values()
+        for file, genre, _ in c.added)
+    needed = [task for task in tasks if task in added]
+
+    training = {}
+    for task, fingerprints in zip(needed,
+            map_tracks(track_fingerprints, needed, jobs)):
+        file, genre = task
+        print "built all hashes for {}".format(get_file_name(file, genre))
+        training[task] = fingerprints
+
+    # update hashes from training set
+    for variant in variants:
+        if databases[variant] is None or len(changes[variant]) > 0:
+            print "updating {}: {} added, {} removed".format(
+                get_database_name(*variant), len(changes[variant].added),
+                len(changes[variant].removed))
+            fingerprints = dict((task, training[task][variant])
+                for task in training)
+            databases[variant] = update_database(get_database_name(*variant),
+                databases[variant], changes[variant], fingerprints)
+
+    return databases, tasks, training
+
+def export_features(jobs=JOBS, dump_csv=False):
+    # build the databases, then export the features of the hash functions
+    # whose table is missing or was computed from other databases (every
+    # track's features depend on all of the training set), and the features
+    # of the test set
+    databases, tasks, training = build(jobs)
+    index = load_variant_db(get_index_name(), get_database_names(), databases)
+    classify_h = [h for h in range(len(H_FUNCTIONS))
+        if not has_table(get_features_name(h), index.signature)]
+
+    # the tracks build left alone still have to be fingerprinted to be
+    # classified
+    missing = [task for task in tasks if task not in training] \
+        if classify_h else []
+    for task, fingerprints in zip(missing,
+            map_tracks(track_fingerprints, missing, jobs)):
+        file, genre = task
+        print "built all hashes for {}".format(get_file_name(file, genre))
+        training[task] = fingerprints
 
     # classify tracks with hashes calculated above
-    for h in range(len(H_FUNCTIONS)):
-
-        melody_file = 'melody_features{}.csv'.format(h)
-        melody_path = 'features/' + melody_file
-
-        if melody_file not in listdir('features'):
-            for setting in range(SETTINGS):
-
-                hash_file = 'melody_hash{}-{}.p'.format(h, setting)
-                hash_file_path = 'pickles/' + hash_file
-                training_hashes = pickle.load(open(hash_file_path, "rb"))
-
-                for genre in GENRES:
-                    for file in listdir('midi-' + genre):
-                        if not file.startswith('.'):
-                            file_name = 'midi-' + genre + '/' + file
-                            print "using hash {}, classifying {} with setting {}".format(h, file_name, setting)
-                            track = Track(file)
-                            # empty the previous samples
-                            sample_hashes = {}
-                            notes = get_notes(file_name)
-                            analyze_voices(notes, track, setting)
-                            build_hashes(h, file, genre, sample_hashes, track)
-                            _, genres = match(training_hashes, sample_hashes)
-                            score = get_classical(genres)
-                            features.setdefault(file, []).append(score)
-
-            export_table(features, melody_path)
+    features = dict((h, LastUpdatedOrderedDict()) for h in classify_h)
+    classify_variants = [(h, setting) for h in classify_h
+        for setting in range(SETTINGS)]
+
+    for file, genre in (tasks if classify_h else []):
+        print "classifying {}".format(get_file_name(file, genre))
+        fingerprints = training[(file, genre)]
+        genres = score_variants(index, dict((variant,
+            fingerprints[variant]) for variant in classify_variants))
+        for h, setting in classify_variants:
+            score = get_classical(genres[(h, setting)])
+            features[h].setdefault(file, []).append(score)
+
+    for h in classify_h:
+        export_table(features[h], get_features_name(h), dump_csv,
+            index.signature)
 
     # classify test set tracks
-    for h in range(len(H_FUNCTIONS)):
-
-        test_file = 'test-features{}.csv'.format(h)
-        test_set = LastUpdatedOrderedDict()
-
-        for setting in range(SETTINGS):
+    test_tasks = [(file, 'test') for file in listdir('test-set')
+        if not file.startswith('.')]
+    test_sets = dict((h, LastUpdatedOrderedDict())
+        for h in range(len(H_FUNCTIONS)))
+
+    for (file, _), fingerprints in zip(test_tasks,
+            map_tracks(track_fingerprints, test_tasks, jobs)):
+        print "testing {}".format(file)
+        genres = score_variants(index, fingerprints)
+        for h, setting in get_variants():
+            score = get_classical(genres[(h, setting)])
+            test_sets[h].setdefault(file, []).append(score)
 
-            hash_file = 'melody_hash{}-{}.p'.format(h, setting)
-            hash_file_path = 'pickles/' + hash_file
-            training_hashes = pickle.load(open(hash_file_path, "rb"))
-
-            for file in listdir('test-set'):
-                if not file.startswith('.'):
-                    print "testing hash {} on {} with setting {}".format(h, file, setting)
-                    track = Track(file)
-                    test_hashes = {}
-                    notes = get_notes('test-set/' + file)
-                    analyze_voices(notes, track, setting)
-                    build_hashes(h, file, 'test', test_hashes, track)
-                    _, genres = match(training_hashes, test_hashes)
-                    score = get_classical(genres)
-                    test_set.setdefault(file, []).append(score)
-
-        export_table(test_set, 'test-features/' + test_file)
+    for h in range(len(H_FUNCTIONS)):
+        test_file = 'test-features{}'.format(h)
+        export_table(test_sets[h], 'test-features/' + test_file, dump_csv)
 
+@profiled('analyze_voices')
 def analyze_voices(notes, track, setting):
-    for note in notes:
-        c = note[CHANNEL]
-        if c not in track.channels:
-            track.channels[c] = Channel(c)
-        track.channels[c].add_onset(note[ONSET])
-        track.channels[c].add_pitch(note[PITCH])
+    # group the notes by channel with a single stable sort, which keeps each
+    # channel's notes in their original order
+    order = np.argsort(notes[:,CHANNEL], kind='mergesort')
+    grouped = notes[order]
+    starts = np.flatnonzero(np.r_[True,
+        grouped[1:,CHANNEL] != grouped[:-1,CHANNEL]])[:len(grouped)]
+    ends = np.r_[starts[1:], len(grouped)]
+
+    # add channels in order of their first note, as the note by note loop
+    # did, since ties between channels are broken by dict order
+    for k in np.argsort(order[starts], kind='mergesort'):
+        c = grouped[starts[k]][CHANNEL]
+        track.channels[c] = Channel(c, grouped[starts[k]:ends[k],ONSET],
+            grouped[starts[k]:ends[k],PITCH])
 
     for channel_name, channel in track.channels.items():
         track.pitch_var[channel_name] = channel.analyze_pitches()
@@ -199,23 +249,82 @@ def analyze_voices(notes, track, setting):
     
     track.choose_melody(setting)
 
-def build_hashes(h, file, genre, hashes, track):
+def track_fingerprints(task):
+    # return the fingerprints of a file for every (hash function, setting),
+    # in a worker process when running with several jobs
+    file, genre = task
+    return notes_fingerprints(file, get_notes(get_file_name(file, genre)))
+
+def notes_fingerprints(file, notes):
+    # return the fingerprints of a track's notes for every (hash function,
+    # setting). The voices are analyzed once, since only the melody channel
+    # depends on the setting.
+    track = Track(file)
+    analyze_voices(notes, track, 0)
+
+    fingerprints = {}
+    channels = {}
+    for setting in range(SETTINGS):
+        track.choose_melody(setting)
+        if track.melody_channel not in channels:
+            peaks = melody_peaks(notes, track, CONFIG.peaks)
+            channels[track.melody_channel] = [hash_function(peaks,
+                config=CONFIG) for hash_function in fingerprint.HASH_FUNCTIONS]
+        for h in range(len(H_FUNCTIONS)):
+            fingerprints[(h, setting)] = channels[track.melody_channel][h]
+
+    return fingerprints
+
+def get_variants():
+    # every (hash function, setting) a track is fingerprinted with
+    return [(h, setting) for h in range(len(H_FUNCTIONS))
+        for setting in range(SETTINGS)]
+
+def get_database_name(h, setting):
+    # databases fingerprinted with other parameters are kept apart
+    return 'pickles/melody_hash{}-{}-{}'.format(h, setting, CONFIG.get_name())
+
+def get_legacy_name(h, setting):
+    # the name the original script saved the database as, which only holds
+    # the fingerprints of the original parameters
+    if not CONFIG.is_original():
+        return None
+    return 'pickles/melody_hash{}-{}'.format(h, setting)
+
+def get_database_names():
+    return dict((variant, get_database_name(*variant))
+        for variant in get_variants())
+
+def get_index_name():
+    # the databases of every variant combined, see fpdb.VariantDB
+    return 'pickles/melody_index-{}'.format(CONFIG.get_name())
+
+def get_features_name(h):
+    # the training feature table of hash function h
+    return 'features/melody_features{}'.format(h)
+
+def get_file_name(file, genre):
     if genre != 'test':
-        file_name = 'midi-' + genre + '/' + file
-    else:
-        file_name = 'test-set/' + file
+        return 'midi-' + genre + '/' + file
+    return 'test-set/' + file
+
+@profiled('build_hashes')
+def build_hashes(h, file, genre, hashes, track):
+    most_frequent = get_melody_peaks(file, genre, track)
+    H_FUNCTIONS[h](file, genre, hashes, most_frequent)
 
-    midi = MIDIFile.from_file(file_name)
+def get_melody_peaks(file, genre, track):
+    midi = load_midi(get_file_name(file, genre))
     notes = midi.notes(unit='ticks')
+    return melody_peaks(notes, track, CONFIG.peaks)
 
+def melody_peaks(notes, track, peaks=TOP_MOST_FREQUENT):
     # filter melody notes only
-    melody = np.array([n for n in notes if n[CHANNEL] == track.melody_channel])
-
-    # filter on most occurring note in melody
-    peak = get_most_frequent_note(melody[:,PITCH])
-    most_frequent = np.array([n for n in melody if n[PITCH] == peak])
+    melody = notes[notes[:,CHANNEL] == track.melody_channel]
 
-    H_FUNCTIONS[h](file, genre, hashes, most_frequent)
+    # filter on the most occurring notes in melody
+    most_frequent = get_most_frequent_notes(melody[:,PITCH], peaks)
+    return melody[np.in1d(melody[:,PITCH], most_frequent)]
 
 if __name__ == '__main__':
     main()
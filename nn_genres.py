@@ -2,65 +2,232 @@ import numpy as np
 import tensorflow as tf
 
 from config import *
+from nnmodel import Model
+from featurestore import FeatureStore
+from profiling import profiled
 from os import listdir
+from sys import argv
 
 OUTPUTS = 2
-TRAINING_TRACKS = 86
-TEST_TRACKS = 19
-
-def base_NN(features, labels, test_features, test_labels, iters=1000, alpha=1e-3):
 
+# number of epochs between two log lines when training verbosely
+LOG_EVERY = 100
+
+# how main trains the saved model: rows per gradient step, the fraction of
+# the training tracks held out for validation, and the number of epochs
+# without a better validation loss after which training stops
+BATCH_SIZE = 32
+VALIDATION_SPLIT = 0.2
+PATIENCE = 50
+
+# metrics of a training run, one value per epoch
+class History():
+    def __init__(self):
+        self.loss = []
+        self.accuracy = []
+        self.val_loss = []
+        self.val_accuracy = []
+        # the epoch whose weights were kept, and the epoch training stopped at
+        self.best_epoch = None
+        self.stopped_epoch = None
+
+    def add(self, loss, accuracy, val_loss=None, val_accuracy=None):
+        self.loss.append(loss)
+        self.accuracy.append(accuracy)
+        if val_loss is not None:
+            self.val_loss.append(val_loss)
+            self.val_accuracy.append(val_accuracy)
+
+    def __str__(self):
+        line = 'epoch {} loss {:.4f} accuracy {:.4f}'.format(len(self.loss),
+            self.loss[-1], self.accuracy[-1])
+        if self.val_loss:
+            line += ' val_loss {:.4f} val_accuracy {:.4f}'.format(
+                self.val_loss[-1], self.val_accuracy[-1])
+        return line
+
+@profiled('base_NN')
+def base_NN(features, labels, test_features, test_labels, iters=1000, alpha=1e-3,
+        columns=None, **options):
+    model, history = train(features, labels, iters, alpha, columns, **options)
+
+    probabilities = compile_predictor(model)(test_features)
+    correct_prediction = np.equal(np.argmax(probabilities, 1),
+        np.argmax(test_labels, 1))
+
+    print np.mean(correct_prediction, dtype=np.float32)
+    print probabilities
+    return model, history
+
+# train the softmax layer for at most iters epochs and return it as a Model,
+# which can be saved and used for predictions without TensorFlow, along with
+# the History of the run.
+#
+# Each epoch takes a gradient step per batch_size rows (all rows at once by
+# default), in a new random order if shuffle is set. If validation_split is
+# set, that fraction of the rows is held out, and training stops once the
+# validation loss has not improved for patience epochs, keeping the best
+# weights. Metrics are logged every log_every epochs if verbose is set.
+@profiled('train')
+def train(features, labels, iters=1000, alpha=1e-3, columns=None,
+        batch_size=None, shuffle=True, validation_split=0.0, patience=None,
+        log_every=LOG_EVERY, verbose=True, seed=None):
     nodes = features.shape[1]
-
-    x = tf.placeholder(tf.float32, [None, nodes])
-
-    W = tf.Variable(tf.random_normal([nodes, OUTPUTS], stddev=0.01))
-    b = tf.Variable(tf.random_normal([OUTPUTS], stddev=0.01))
-
-    layer1 = tf.matmul(x, W) + b
-
-    y = tf.nn.softmax(layer1)
-    y_ = tf.placeholder(tf.float32, [None, OUTPUTS])
-
-    NLL = -tf.reduce_sum(y_ * tf.log(y))
-
-    train_step = tf.train.GradientDescentOptimizer(alpha).minimize(NLL)
-
-    init = tf.global_variables_initializer()
-    sess = tf.Session()
-    sess.run(init)
-
-    correct_prediction = tf.equal(tf.argmax(y,1), tf.argmax(y_,1))
-    accuracy = tf.reduce_mean(tf.cast(correct_prediction, tf.float32))
-
-    for i in range(iters):
-        sess.run(train_step, feed_dict={x: features, y_: labels})
-        print sess.run(accuracy, feed_dict={x: features, y_: labels})
-        print sess.run(tf.trainable_variables()[0])
-
-    print sess.run(accuracy, feed_dict={x: test_features, y_: test_labels})
-    print sess.run(y, feed_dict={x: test_features, y_: test_labels})
-
-def main():
-
-    x = np.array([]).reshape(TRAINING_TRACKS, 0)
-    test_x = np.array([]).reshape(TEST_TRACKS, 0)
-
-    for file in listdir('features'):
-        if not file.startswith('.'):
-            if file != 'pitch_features.csv':
-                x = np.hstack((x, np.loadtxt(open('features/' + file, 'rb'), delimiter=',')))
-
-    y_ = np.loadtxt(open(LABELS_FILE, 'rb'), delimiter=',')
-
-    for file in listdir('test-features'):
-        if not file.startswith('.'):
-            test_x = np.hstack((test_x, np.loadtxt(open('test-features/' + file, 'rb'), delimiter=',')))
-
-    test_y = np.zeros((TEST_TRACKS, OUTPUTS), dtype=np.int)
+    if columns is None:
+        columns = [str(i) for i in range(nodes)]
+
+    rng = np.random.RandomState(seed)
+    features = np.asarray(features, dtype=np.float32)
+    labels = np.asarray(labels, dtype=np.float32)
+
+    val_features = val_labels = None
+    if validation_split > 0:
+        order = rng.permutation(len(features))
+        held_out = max(int(len(features) * validation_split), 1)
+        val_features = features[order[:held_out]]
+        val_labels = labels[order[:held_out]]
+        features = features[order[held_out:]]
+        labels = labels[order[held_out:]]
+
+    if batch_size is None:
+        batch_size = len(features)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        if seed is not None:
+            tf.set_random_seed(seed)
+
+        x = tf.placeholder(tf.float32, [None, nodes])
+
+        W = tf.Variable(tf.random_normal([nodes, OUTPUTS], stddev=0.01))
+        b = tf.Variable(tf.random_normal([OUTPUTS], stddev=0.01))
+
+        layer1 = tf.matmul(x, W) + b
+
+        y = tf.nn.softmax(layer1)
+        y_ = tf.placeholder(tf.float32, [None, OUTPUTS])
+
+        NLL = -tf.reduce_sum(y_ * tf.log(y))
+
+        train_step = tf.train.GradientDescentOptimizer(alpha).minimize(NLL)
+
+        init = tf.global_variables_initializer()
+
+        correct_prediction = tf.equal(tf.argmax(y,1), tf.argmax(y_,1))
+        correct = tf.reduce_sum(tf.cast(correct_prediction, tf.float32))
+
+    history = History()
+    with tf.Session(graph=graph) as sess:
+        sess.run(init)
+
+        best_loss = None
+        best = None
+        epoch = None
+        for epoch in range(iters):
+            order = rng.permutation(len(features)) if shuffle else \
+                np.arange(len(features))
+
+            # the loss and accuracy of each batch are fetched with its step,
+            # so an epoch costs no extra pass over the data
+            loss = hits = 0.0
+            for start in range(0, len(features), batch_size):
+                batch = order[start:start + batch_size]
+                _, batch_loss, batch_hits = sess.run([train_step, NLL, correct],
+                    feed_dict={x: features[batch], y_: labels[batch]})
+                loss += batch_loss
+                hits += batch_hits
+
+            if val_features is None:
+                history.add(loss / len(features), hits / len(features))
+            else:
+                val_loss, val_hits = sess.run([NLL, correct],
+                    feed_dict={x: val_features, y_: val_labels})
+                history.add(loss / len(features), hits / len(features),
+                    val_loss / len(val_features),
+                    val_hits / len(val_features))
+
+                if best_loss is None or history.val_loss[-1] < best_loss:
+                    best_loss = history.val_loss[-1]
+                    best = sess.run([W, b])
+                    history.best_epoch = epoch
+                elif patience is not None and \
+                        epoch - history.best_epoch >= patience:
+                    break
+
+            if verbose and (epoch + 1) % log_every == 0:
+                print history
+
+        history.stopped_epoch = epoch
+        if best is None:
+            best = sess.run([W, b])
+            history.best_epoch = epoch
+
+    weights, biases = best
+    return Model(weights, biases, columns, GENRES), history
+
+# return a function mapping a batch of feature rows to genre probabilities,
+# with the graph built and the session opened once rather than per call
+def compile_predictor(model):
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, [None, model.weights.shape[0]])
+        W = tf.constant(model.weights, dtype=tf.float32)
+        b = tf.constant(model.biases, dtype=tf.float32)
+        y = tf.nn.softmax(tf.matmul(x, W) + b)
+
+    sess = tf.Session(graph=graph)
+
+    def predict(features):
+        return sess.run(y, feed_dict={x: np.atleast_2d(features)})
+
+    return predict
+
+# train the model on the exported features and save it. Mini-batches and
+# early stopping are turned off with a batch_size of None and a
+# validation_split of 0 (python nn_genres.py --batch-size 0
+# --validation-split 0).
+def main(batch_size=BATCH_SIZE, validation_split=VALIDATION_SPLIT,
+        patience=PATIENCE):
+    names, x, columns = FeatureStore('features',
+        exclude=['pitch_features']).load()
+    y_ = get_labels(names)
+
+    # the test features of each hash function are named test-features{h}
+    # rather than melody_features{h}
+    test_names, test_x, test_columns = FeatureStore('test-features').load()
+    test_columns = [c.replace('test-features', 'melody_features')
+        for c in test_columns]
+    test_x = test_x[:,[test_columns.index(c) for c in columns]]
+
+    test_y = np.zeros((len(test_names), OUTPUTS), dtype=np.int)
     test_y[:,0] = 1
 
-    base_NN(x, y_, test_x, test_y)
+    model, history = base_NN(x, y_, test_x, test_y, columns=columns,
+        batch_size=batch_size or None, validation_split=validation_split,
+        patience=patience if validation_split > 0 else None)
+    print 'stopped at epoch {}, keeping epoch {}'.format(
+        history.stopped_epoch, history.best_epoch)
+    model.save(MODEL_FILE)
+
+# return the one-hot genre labels of the given training tracks, found from the
+# genre directory each track is in. Tracks of feature files written before
+# track names were recorded are named by position, so their labels are read
+# from LABELS_FILE by position instead.
+def get_labels(names):
+    if names and names[0].startswith('#'):
+        labels = np.loadtxt(open(LABELS_FILE, 'rb'), delimiter=',')
+        return labels[[int(name[1:]) for name in names]]
+
+    genres = {}
+    for i, genre in enumerate(GENRES):
+        for file in listdir('midi-' + genre):
+            genres[file] = i
+
+    labels = np.zeros((len(names), OUTPUTS), dtype=np.int)
+    labels[np.arange(len(names)), [genres[name] for name in names]] = 1
+    return labels
 
 if __name__ == '__main__':
-    main()
+    main(get_option(argv, '--batch-size', BATCH_SIZE, int),
+        get_option(argv, '--validation-split', VALIDATION_SPLIT, float),
+        get_option(argv, '--patience', PATIENCE, int))
@@ -0,0 +1,83 @@
+import numpy as np
+
+from os import rename
+
+# The network trained by nn_genres.py is a single softmax layer, so once its
+# weights are saved, predicting genres is one matrix product. This module
+# holds the trained weights and that prediction in plain NumPy, so that
+# classifying new tracks (see server.py) never has to import TensorFlow.
+
+class Model():
+    """
+    A trained softmax layer mapping feature rows to genre probabilities.
+
+    === Attributes ===
+    @param numpy.ndarray weights: the weights, of shape (features, genres)
+    @param numpy.ndarray biases: the biases, one per genre
+    @param list[str] columns: the name of each feature column, in order
+    @param list[str] genres: the genre of each output
+    """
+
+    def __init__(self, weights, biases, columns, genres):
+        """
+        Creates a model from trained weights.
+
+        @rtype: None
+        """
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.biases = np.asarray(biases, dtype=np.float64)
+        self.columns = list(columns)
+        self.genres = list(genres)
+
+    def predict(self, features):
+        """
+        Return the genre probabilities of a batch of feature rows, one row of
+        probabilities per feature row.
+
+        @param Model self: this model
+        @param numpy.ndarray features: feature rows, of shape (n, features)
+        @rtype: numpy.ndarray
+        """
+        features = np.atleast_2d(np.asarray(features, dtype=np.float64))
+        logits = np.dot(features, self.weights) + self.biases
+
+        # subtracting the largest logit keeps exp from overflowing
+        logits -= logits.max(axis=1)[:,np.newaxis]
+        probabilities = np.exp(logits)
+        return probabilities / probabilities.sum(axis=1)[:,np.newaxis]
+
+    def classify(self, features):
+        """
+        Return the most probable genre of each feature row.
+
+        @param Model self: this model
+        @param numpy.ndarray features: feature rows, of shape (n, features)
+        @rtype: list[str]
+        """
+        return [self.genres[i] for i in self.predict(features).argmax(axis=1)]
+
+    def save(self, path):
+        """
+        Save this model to path, an .npz file.
+
+        @param Model self: this model
+        @param str path: the path of the model file
+        @rtype: None
+        """
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, weights=self.weights, biases=self.biases,
+            columns=np.array(self.columns, dtype=np.str_),
+            genres=np.array(self.genres, dtype=np.str_))
+        rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load the model saved in path.
+
+        @param str path: the path of the model file
+        @rtype: Model
+        """
+        with np.load(path) as data:
+            return cls(data['weights'], data['biases'],
+                data['columns'].tolist(), data['genres'].tolist())
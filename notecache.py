@@ -0,0 +1,251 @@
+import numpy as np
+import hashlib
+
+from os import getpid, makedirs, remove, rename
+from os.path import isdir, isfile
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from profiling import profiled
+
+# Parsing a MIDI file with madmom is by far the most expensive step of every
+# script in this project, and the same files are parsed over and over again
+# (once per hash function and setting in melody.py). Each track is parsed
+# once, and only what the scripts actually use is kept: the note matrix in
+# ticks, the resolution and the time signature event.
+#
+# Importing madmom takes longer than reading a cached track, so it is only
+# imported when a track actually has to be parsed.
+
+# directory where parsed tracks are stored as compressed NumPy files
+CACHE_DIR = 'cache/notes'
+
+# number of parsed tracks kept in memory
+CACHE_SIZE = 256
+
+# madmom parse options, part of the cache key (see get_parse_options)
+UNIT = 'ticks'
+PARSE_OPTIONS = None
+
+class CachedMIDI():
+    """
+    The parts of a madmom MIDIFile that are used for classification.
+
+    === Attributes ===
+    @param int resolution: the number of ticks per beat
+    @param list[int] time_signature: the data of the first time signature
+        event of the first track, or None if there isn't one
+    """
+
+    def __init__(self, notes, resolution, time_signature):
+        """
+        Creates a CachedMIDI from a parsed note matrix.
+
+        @param numpy.ndarray notes: notes in the madmom library format
+        @param int resolution: the number of ticks per beat
+        @param list[int] time_signature: the time signature event data
+        @rtype: None
+        """
+        # shared by every caller of load_midi, so it must not be modified
+        notes.flags.writeable = False
+        self._notes = notes
+        self.resolution = resolution
+        self.time_signature = time_signature
+
+    def notes(self, unit=UNIT):
+        """
+        Return the notes of this track, like MIDIFile.notes. Only ticks are
+        cached.
+
+        @param CachedMIDI self: this track
+        @param str unit: the time unit of the notes
+        @rtype: numpy.ndarray
+        """
+        if unit != UNIT:
+            raise ValueError('only {} are cached, not {}'.format(UNIT, unit))
+        return self._notes
+
+class LRUCache(OrderedDict):
+    'Store at most size items, dropping the least recently used one'
+
+    def __init__(self, size):
+        OrderedDict.__init__(self)
+        self.size = size
+        # the server parses uploads on several threads at once
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                return default
+            value = OrderedDict.pop(self, key)
+            OrderedDict.__setitem__(self, key, value)
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self:
+                OrderedDict.__delitem__(self, key)
+            OrderedDict.__setitem__(self, key, value)
+            if len(self) > self.size:
+                self.popitem(last=False)
+
+TRACKS = LRUCache(CACHE_SIZE)
+
+def load_midi(file_name):
+    """
+    Return the parsed MIDI file, parsing it only if the same content has not
+    been parsed before (by this process or any earlier run).
+
+    @param str file_name: the path of the MIDI file
+    @rtype: CachedMIDI
+    """
+    with open(file_name, 'rb') as f:
+        content = f.read()
+
+    return load_midi_data(content, file_name)
+
+@profiled('load_midi')
+def load_midi_data(content, file_name=None):
+    """
+    Return the parsed MIDI file with the given content, parsing it only if
+    the same content has not been parsed before. Only files on disk are
+    added to the on-disk cache, so that classifying uploads does not fill
+    it up.
+
+    @param str content: the raw bytes of the MIDI file
+    @param str file_name: the path of the MIDI file, if it is on disk
+    @rtype: CachedMIDI
+    """
+    key = get_key(content)
+
+    midi = TRACKS.get(key)
+    if midi is None:
+        cache_path = '{}/{}.npz'.format(CACHE_DIR, key)
+        if isfile(cache_path):
+            midi = read_cache(cache_path)
+        elif file_name is not None:
+            midi = parse_midi(file_name)
+            write_cache(cache_path, midi)
+        else:
+            midi = parse_midi_data(content)
+        TRACKS[key] = midi
+
+    return midi
+
+def get_key(content):
+    """
+    Return the cache key of a MIDI file, which depends on its content and the
+    options used to parse it.
+
+    @param str content: the raw bytes of the MIDI file
+    @rtype: str
+    """
+    digest = hashlib.sha1(content)
+    digest.update(get_parse_options())
+    return digest.hexdigest()
+
+def get_parse_options():
+    """
+    Return the options tracks are parsed with, including the version of
+    madmom, which is read from its package metadata rather than by importing
+    it.
+
+    @rtype: str
+    """
+    global PARSE_OPTIONS
+    if PARSE_OPTIONS is None:
+        PARSE_OPTIONS = 'unit={};madmom={}'.format(UNIT, get_madmom_version())
+    return PARSE_OPTIONS
+
+def get_madmom_version():
+    """
+    Return the version of the madmom that is imported, from its distribution
+    metadata, which is quicker to load than madmom itself.
+
+    @rtype: str
+    """
+    import pkg_resources
+    try:
+        return pkg_resources.get_distribution('madmom').version
+    except pkg_resources.DistributionNotFound:
+        # not installed from a distribution, such as a source checkout
+        import madmom
+        return madmom.__version__
+
+@profiled('parse_midi')
+def parse_midi(file_name):
+    """
+    Parse a MIDI file with madmom.
+
+    @param str file_name: the path of the MIDI file
+    @rtype: CachedMIDI
+    """
+    from madmom.utils.midi import MIDIFile, TimeSignatureEvent
+
+    midi = MIDIFile.from_file(file_name)
+
+    # only works for type 1 midi files, where the first track holds the meta
+    # events (see config.get_ticks_per_bar)
+    time_signature = None
+    for event in midi.tracks[0].events:
+        if isinstance(event, TimeSignatureEvent):
+            time_signature = list(event.data)
+            break
+
+    return CachedMIDI(midi.notes(unit=UNIT), midi.resolution, time_signature)
+
+def parse_midi_data(content):
+    """
+    Parse the raw bytes of a MIDI file with madmom, which can only read MIDI
+    files from disk.
+
+    @param str content: the raw bytes of the MIDI file
+    @rtype: CachedMIDI
+    """
+    midi_file = NamedTemporaryFile(suffix='.mid', delete=False)
+    try:
+        midi_file.write(content)
+        midi_file.close()
+        return parse_midi(midi_file.name)
+    finally:
+        remove(midi_file.name)
+
+def read_cache(cache_path):
+    """
+    Read a parsed MIDI file from the on-disk cache.
+
+    @param str cache_path: the path of the cached track
+    @rtype: CachedMIDI
+    """
+    # reading a member copies it out of the archive, which is then closed
+    with np.load(cache_path) as data:
+        notes = data['notes']
+        resolution = int(data['resolution'])
+        time_signature = data['time_signature'].tolist()
+    if not time_signature:
+        time_signature = None
+    return CachedMIDI(notes, resolution, time_signature)
+
+def write_cache(cache_path, midi):
+    """
+    Write a parsed MIDI file to the on-disk cache. The file is renamed into
+    place so that concurrent runs never read a partially written track.
+
+    @param str cache_path: the path of the cached track
+    @param CachedMIDI midi: the parsed MIDI file
+    @rtype: None
+    """
+    if not isdir(CACHE_DIR):
+        try:
+            makedirs(CACHE_DIR)
+        except OSError:
+            # another process created it in the meantime
+            pass
+
+    time_signature = midi.time_signature or []
+    tmp_path = '{}.{}.tmp.npz'.format(cache_path[:-len('.npz')], getpid())
+    np.savez_compressed(tmp_path, notes=midi.notes(unit=UNIT),
+        resolution=midi.resolution,
+        time_signature=np.array(time_signature, dtype=np.int64))
+    rename(tmp_path, cache_path)
@@ -1,12 +1,14 @@
-import matplotlib.pyplot as plt
 import warnings
 import pickle
+import config
+import fingerprint
 
 from config import *
 from sys import argv
 from os import listdir
-from madmom.utils.midi import MIDIFile
-from heapq import nlargest
+from notecache import load_midi
+from fpdb import get_changes, load_database, update_database
+from profiling import profiled
 from pprint import pprint
 
 # Shazam: https://www.ee.columbia.edu/~dpwe/papers/Wang03-shazam.pdf
@@ -26,12 +28,24 @@ from pprint import pprint
 # genres being considered when classifying MIDI files
 GENRES = ['classical', 'rock']
 
-# most frequent pitches that occur in the MIDI file
+# number of most frequent pitches that occur in the MIDI file used as peaks
 TOP_MOST_FREQUENT = 1
 
 # number of other peaks that each peak is paired to
 FAN_FACTOR = 5
 
+# When scoring by aligned matches, the sample fingerprints are looked up
+# ALIGN_CHUNK at a time (expanding at most ALIGN_ROWS postings at once), and
+# the lookup stops once the best aligned training track has at least
+# MIN_ALIGNED aligned matches and DOMINANCE times as many as any other track
+ALIGN_CHUNK = 1024
+ALIGN_ROWS = 2 ** 20
+MIN_ALIGNED = 20
+DOMINANCE = 2.0
+
+# onset offsets are stored as (track * OFFSET_SPAN + offset + OFFSET_SPAN / 2)
+OFFSET_SPAN = 2 ** 40
+
 # indices for MIDI note attributes, according to the madmom library
 ONSET = 0
 PITCH = 1
@@ -142,14 +156,17 @@ class Bucket():
         match occurs within the sample MIDI file
     """
 
-    def __init__(self):
+    def __init__(self, training_times=None, sample_times=None):
         """
-        Creates an empty bucket.
+        Creates a bucket, empty unless the matching training and sample
+        timestamps are given.
 
+        @param list[int] training_times: the training timestamps
+        @param list[int] sample_times: the sample timestamps
         @rtype: None
         """
-        self._training_times = []
-        self._sample_times = []
+        self._training_times = training_times or []
+        self._sample_times = sample_times or []
 
     def get_training_times(self):
         """
@@ -191,59 +208,248 @@ class Bucket():
         """
         self._sample_times.append(time)
 
+class Matches():
+    """
+    All hash matches between a sample MIDI file and a training database, one
+    entry per (sample fingerprint, training fingerprint) pair with equal
+    hashes.
+
+    === Attributes ===
+    @param FingerprintDB training: the database the sample was matched with
+    @param numpy.ndarray sample_onsets: the onset of each match in the sample
+    @param numpy.ndarray training_onsets: the onset of each match in the
+        training MIDI file
+    @param numpy.ndarray tracks: the training track id of each match
+    @param numpy.ndarray genres: the training genre id of each match
+    """
+
+    def __init__(self, training, sample_onsets, training_onsets, tracks,
+            genres):
+        """
+        Creates the matches of a sample against the training database.
+
+        @rtype: None
+        """
+        self.training = training
+        self.sample_onsets = sample_onsets
+        self.training_onsets = training_onsets
+        self.tracks = tracks
+        self.genres = genres
+
+    def __len__(self):
+        """
+        Return the number of matches.
+
+        @param Matches self: these matches
+        @rtype: int
+        """
+        return len(self.tracks)
+
+    def get_buckets(self):
+        """
+        Return one bucket of matching timestamps per training track, keyed by
+        the track name.
+
+        @param Matches self: these matches
+        @rtype: dict(str: Bucket)
+        """
+        if len(self) == 0:
+            return {}
+
+        order = np.argsort(self.tracks, kind='mergesort')
+        tracks = self.tracks[order]
+        training_onsets = self.training_onsets[order]
+        sample_onsets = self.sample_onsets[order]
+
+        starts = np.flatnonzero(np.r_[True, tracks[1:] != tracks[:-1]])
+        ends = np.r_[starts[1:], len(tracks)]
+
+        buckets = {}
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            bucket_name = self.training.track_names[tracks[start]]
+            buckets[bucket_name] = Bucket(
+                training_onsets[start:end].tolist(),
+                sample_onsets[start:end].tolist())
+        return buckets
+
+    def get_genres(self):
+        """
+        Return the number of matches per genre.
+
+        @param Matches self: these matches
+        @rtype: dict(str: int)
+        """
+        counts = np.bincount(self.genres,
+            minlength=len(self.training.genre_names))
+        return dict((self.training.genre_names[g], int(counts[g]))
+            for g in np.flatnonzero(counts))
+
+    def get_offsets(self):
+        """
+        Return, for every matched training track, the most common time offset
+        between its matches and the sample (the peak of the track's offset
+        histogram) and how many matches share that offset. Matches of a track
+        that is the same piece as the sample line up along a single offset.
+
+        @param Matches self: these matches
+        @rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        """
+        if len(self) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+
+        offsets = self.training_onsets - self.sample_onsets
+        order = np.lexsort((offsets, self.tracks))
+        tracks = self.tracks[order]
+        offsets = offsets[order]
+
+        # histogram bins are runs of equal (track, offset)
+        new_bin = np.r_[True, (tracks[1:] != tracks[:-1]) |
+            (offsets[1:] != offsets[:-1])]
+        bin_starts = np.flatnonzero(new_bin)
+        bin_counts = np.diff(np.r_[bin_starts, len(tracks)])
+        bin_tracks = tracks[bin_starts]
+        bin_offsets = offsets[bin_starts]
+
+        # within each track, pick the fullest bin (the earliest offset on ties)
+        by_count = np.lexsort((bin_offsets, -bin_counts, bin_tracks))
+        first = np.r_[True, bin_tracks[by_count][1:] !=
+            bin_tracks[by_count][:-1]]
+        peaks = by_count[first]
+
+        return bin_tracks[peaks], bin_offsets[peaks], bin_counts[peaks]
+
+    def get_genre_scores(self):
+        """
+        Return the number of time-aligned matches (see get_offsets) per genre.
+
+        @param Matches self: these matches
+        @rtype: dict(str: int)
+        """
+        tracks, _, aligned = self.get_offsets()
+        track_genres = self.training.genres_of(tracks)
+        scores = np.bincount(track_genres, weights=aligned,
+            minlength=len(self.training.genre_names))
+        return dict((self.training.genre_names[g], int(scores[g]))
+            for g in np.flatnonzero(scores))
+
+    def get_best_tracks(self, n=1):
+        """
+        Return up to n training tracks with the most time-aligned matches, as
+        (track name, offset, aligned matches) tuples, best first.
+
+        @param Matches self: these matches
+        @param int n: the number of tracks to return
+        @rtype: list[(str, int, int)]
+        """
+        tracks, offsets, aligned = self.get_offsets()
+        best = np.argsort(-aligned, kind='mergesort')[:n]
+        return [(self.training.track_names[tracks[i]], int(offsets[i]),
+            int(aligned[i])) for i in best]
+
 def main():
     
     load_settings()
+    jobs = get_jobs(argv)
+    dump_csv = get_flag(argv, '--csv')
+    options = fingerprint.get_config(argv)
 
     hash_functions = {
-        "0": hash_time_diff,
-        "1": hash_time_diff_percentile
+        "0": fingerprint.time_diff,
+        "1": fingerprint.time_diff_percentile
     }
 
     if len(argv) != 2 or int(argv[1]) not in range(len(hash_functions)):
-        print "usage: pitches.py <int in range(" + str(len(hash_functions)) + ")>"
+        print "usage: pitches.py [--jobs N] [--csv] [--max-gap N] [--quantum N] [--layout L] [--peaks N] <int in range(" + str(len(hash_functions)) + ")>"
         return
 
     features = LastUpdatedOrderedDict()
 
-    # build hashes
-    for f in range(1, FAN_FACTOR):   
-
-        hash_file = 'pitches_hash{}-{}.p'.format(argv[1], f)
-        hash_file_path = 'pickles/' + hash_file
+    # one database per fan factor, each fingerprinted with its own and the
+    # other parameters given on the command line
+    configs = [fingerprint.FingerprintConfig(fan_factor=f,
+        max_gap=options.max_gap, layout=options.layout,
+        quantum=options.quantum, peaks=options.peaks)
+        for f in range(1, FAN_FACTOR)]
+    databases = {}
 
-        if hash_file not in listdir('pickles'):
-            training_hashes = {}
-            for genre in GENRES:
-                for training_file in listdir('midi-' + genre):
-                    if not training_file.startswith('.'):
-                        file_name = 'midi-' + genre + '/' + training_file
-                        print "building hashes for {} with setting {}".format(file_name, f)
-                        build_hash_table(training_file, training_hashes, genre,
-                            hash_functions[argv[1]], f)
-
-            pickle.dump(training_hashes, open(hash_file_path, "wb"))
-
-        else:
-            training_hashes = pickle.load(open(hash_file_path, "rb"))
-
-    for f in range(1, FAN_FACTOR):
+    # build hashes
+    for config in configs:
+        hash_file_path = get_hash_file_path(argv[1], config)
+        training_hashes = load_database(hash_file_path,
+            get_legacy_path(argv[1], config))
+
+        # only fingerprint files that were added or modified since the
+        # database was built
+        files = [(training_file, genre, 'midi-' + genre + '/' + training_file)
+            for genre in GENRES
+            for training_file in listdir('midi-' + genre)
+            if not training_file.startswith('.')]
+        changes = get_changes(training_hashes, files)
+
+        if training_hashes is None or len(changes) > 0:
+            tasks = [(hash_functions[argv[1]], training_file, genre, config)
+                for training_file, genre, _ in changes.added]
+
+            fingerprints = {}
+            for task, track_fingerprints in zip(tasks,
+                    map_tracks(peak_fingerprints, tasks, jobs)):
+                _, training_file, genre, _ = task
+                file_name = 'midi-' + genre + '/' + training_file
+                print "built hashes for {} with setting {}".format(file_name,
+                    config.fan_factor)
+                fingerprints[(training_file, genre)] = track_fingerprints
+
+            training_hashes = update_database(hash_file_path,
+                training_hashes, changes, fingerprints)
+        databases[config] = training_hashes
+
+    for config in configs:
         for genre in GENRES:
             for sample_file in listdir('midi-' + genre):
                 if not sample_file.startswith('.'):
-                    print "classifying {} with setting {}".format(sample_file, f)
-                    sample_hashes = {}
-                    build_hash_table(sample_file, sample_hashes, genre,
-                        hash_functions[argv[1]], f)
-
-                    buckets, genres = match(training_hashes, sample_hashes)
+                    print "classifying {} with setting {}".format(sample_file,
+                        config.fan_factor)
+                    peaks = get_peak_notes(sample_file, genre, config.peaks)
+                    sample_hashes = hash_functions[argv[1]](peaks,
+                        config=config)
+
+                    # only the genres of the matches are needed, and some
+                    # tracks have tens of millions of them
+                    genres = score_genres(databases[config], sample_hashes)
                     score = get_classical(genres)
                     features.setdefault(sample_file, []).append(score)
-                    # plot_graph(buckets)
+                    # plot_graph(match(databases[config], sample_hashes)[0])
 
     pprint (features)
-    export_table(features, PITCH_FEATURES)
+    export_table(features, PITCH_FEATURES, dump_csv)
+
+def get_hash_file_path(h, config):
+    """
+    Return the name of the database of the hash function numbered h (as
+    given on the command line) with the fingerprint configuration config.
+
+    @param str h: the number of the hash function
+    @param FingerprintConfig config: the fingerprint parameters
+    @rtype: str
+    """
+    return 'pickles/pitches_hash{}-{}'.format(h, config.get_name())
 
+def get_legacy_path(h, config):
+    """
+    Return the name the original script saved the database of the hash
+    function numbered h with the fingerprint configuration config as, or
+    None if it never built databases with that configuration.
+
+    @param str h: the number of the hash function
+    @param FingerprintConfig config: the fingerprint parameters
+    @rtype: str
+    """
+    if not config.is_original():
+        return None
+    return 'pickles/pitches_hash{}-{}'.format(h, config.fan_factor)
+
+@profiled('build_hash_table')
 def build_hash_table(file, hashes, genre, hash_function, fan_factor):
     """
     Build a dictionary of peak frequency hashes as keys and their
@@ -253,63 +459,436 @@ def build_hash_table(file, hashes, genre, hash_function, fan_factor):
     @param str directory: the name of the directory
     @param dict(int: PeakPair) hashes: the peak pair database
     @param str genre: the genre of this MIDI file
-    @param function hash_function: the hash function to be used for dictionary
-    keys
+    @param function hash_function: the fingerprint function to be used for
+    dictionary keys
+    @param int fan_factor: the number of other peaks each peak is paired to
     @rtype: None
     """
+    most_frequent = get_peak_notes(file, genre)
+    config = fingerprint.FingerprintConfig(fan_factor=fan_factor)
+
+    # generate hashes for these peak pitches
+    add_fingerprints(file, genre, hashes, hash_function(most_frequent,
+        config=config))
+
+def peak_fingerprints(task):
+    """
+    Return the fingerprints of the peak notes of a MIDI file, where task is a
+    (fingerprint function, file, genre, fingerprint configuration) tuple.
+    Used as the worker function when building training databases with
+    several jobs.
+
+    @param tuple task: the fingerprint function, file name, genre and
+        configuration
+    @rtype: numpy.ndarray
+    """
+    hash_function, file, genre, config = task
+    return hash_function(get_peak_notes(file, genre, config.peaks),
+        config=config)
+
+def get_peak_notes(file, genre, peaks=TOP_MOST_FREQUENT):
+    """
+    Return the notes of a MIDI file of a certain genre whose pitch is one of
+    its most frequent (peak) pitches, without duplicate notes: of the notes
+    of a pitch at the same onset, only the first is kept, but notes of
+    different peak pitches at the same onset are all kept, ordered by pitch.
+
+    @param str file: the name of the file
+    @param str genre: the genre of this MIDI file
+    @param int peaks: the number of peak pitches
+    @rtype: numpy.ndarray
+    """
     if genre != 'sample':
         file_name = 'midi-' + genre + '/' + file
     else:
         file_name = 'test-set/' + file
 
-    midi = MIDIFile.from_file(file_name)
+    midi = load_midi(file_name)
     notes = midi.notes(unit='ticks')
-    peak = get_most_frequent_note(notes[:,PITCH])
-
-    most_frequent = []
-    for note in notes:
-        # only consider peak pitches
-        if note[PITCH] == peak:
-            if len(most_frequent) > 0:
-                # don't add a duplicate (considering onset)
-                if most_frequent[-1][ONSET] != note[ONSET]:
-                    most_frequent.append(note)
-            else:
-                most_frequent.append(note)
+    most_frequent = notes[np.in1d(notes[:,PITCH],
+        get_most_frequent_notes(notes[:,PITCH], peaks))]
 
-    # generate hashes for these peak pitches
-    hash_function(file, genre, hashes, most_frequent, fan_factor)
+    # don't add a duplicate (considering onset and pitch)
+    most_frequent = most_frequent[np.lexsort((most_frequent[:,PITCH],
+        most_frequent[:,ONSET]))]
+    first = np.r_[True, (most_frequent[1:,ONSET] != most_frequent[:-1,ONSET])
+        | (most_frequent[1:,PITCH] != most_frequent[:-1,PITCH])]
+    return most_frequent[first]
 
+@profiled('match')
 def match(training, sample):
     """
     Return all buckets representing hash matches between the sample MIDI file
     and each individual training MIDI file (one per bucket). Also return a
     tally of matches according to genres.
 
-    @param dict(int: PeakPair) training: the peak pair database
-    @param dict(int: PeakPair) sample: the peak pairs of the sample MIDI file
+    @param FingerprintDB training: the peak pair database
+    @param numpy.ndarray sample: the fingerprints of the sample MIDI file
     @rtype: dict(str: Bucket), dict(str: int)
     """
-    buckets = {}
-    genres = {}
+    matches = join(training, sample)
+    return matches.get_buckets(), matches.get_genres()
 
-    for key, value in sample.items():
-        if key in training:
-            for sample_time in value:
-                for training_time in training[key]:
-                    # check sample is not matching on itself
-                    # if sample_time.file_name != training_time.file_name:
-                    bucket_name = training_time.file_name
-                    if key in training:
-                        if bucket_name not in buckets:
-                            # make a new bucket for this track (use track name)
-                            buckets[bucket_name] = Bucket()
+@profiled('join')
+def join(training, sample):
+    """
+    Return every match between the fingerprints of the sample MIDI file and
+    the training database. Each sample hash is looked up with a binary search
+    and its posting list is expanded with array operations, so no Python code
+    runs per match.
+
+    @param FingerprintDB training: the peak pair database
+    @param numpy.ndarray sample: the fingerprints of the sample MIDI file, or
+        a dict of hash: list of PeakPair
+    @rtype: Matches
+    """
+    if isinstance(sample, dict):
+        sample = table_fingerprints(sample)
+
+    starts = np.searchsorted(training.hashes, sample['hash'], side='left')
+    ends = np.searchsorted(training.hashes, sample['hash'], side='right')
+    sample_rows, training_rows = expand(starts, ends)
 
-                        buckets[bucket_name].add_training_time(training_time.onset)
-                        buckets[bucket_name].add_sample_time(sample_time.onset)
-                        genres[training_time.genre] = genres.get(training_time.genre, 0) + 1
+    return Matches(training, sample['onset'][sample_rows],
+        np.asarray(training.onsets[training_rows]),
+        np.asarray(training.tracks[training_rows]),
+        np.asarray(training.genres[training_rows]))
+
+@profiled('count_genres')
+def count_genres(training, sample):
+    """
+    Return the number of matches per genre between the fingerprints of the
+    sample MIDI file and the training database, as Matches.get_genres would,
+    without expanding the matches.
 
-    return buckets, genres
+    @param FingerprintDB training: the peak pair database
+    @param numpy.ndarray sample: the fingerprints of the sample MIDI file
+    @rtype: dict(str: int)
+    """
+    starts = np.searchsorted(training.hashes, sample['hash'], side='left')
+    ends = np.searchsorted(training.hashes, sample['hash'], side='right')
+    counts = training.count_genres(starts, ends).sum(axis=0)
+    return dict((training.genre_names[g], int(counts[g]))
+        for g in np.flatnonzero(counts))
+
+def score_genres(training, sample, variant=None, scoring=None):
+    """
+    Return the genre scores get_classical takes for the fingerprints of the
+    sample MIDI file, matched against the training database (or one of its
+    variants), according to scoring (config.SCORING if not given).
+
+    @param FingerprintDB training: the peak pair database, or a VariantDB
+    @param numpy.ndarray sample: the fingerprints of the sample MIDI file
+    @param tuple variant: the variant to match, if training is a VariantDB
+    @param str scoring: 'matches' or 'aligned'
+    @rtype: dict(str: int)
+    """
+    scoring = scoring or config.SCORING
+    if scoring == 'aligned':
+        return align_genres(training, sample, variant)
+    if scoring != 'matches':
+        raise ValueError('unknown scoring {}'.format(scoring))
+    if variant is None:
+        return count_genres(training, sample)
+    return count_variant_genres(training, {variant: sample})[variant]
+
+def score_variants(training, samples, scoring=None):
+    """
+    Return the genre scores of the fingerprints of the sample MIDI file for
+    each variant of the training databases, according to scoring
+    (config.SCORING if not given).
+
+    @param VariantDB training: the combined peak pair databases
+    @param dict(tuple: numpy.ndarray) samples: the fingerprints of the sample
+        MIDI file for each variant to match
+    @param str scoring: 'matches' or 'aligned'
+    @rtype: dict(tuple: dict(str: int))
+    """
+    scoring = scoring or config.SCORING
+    if scoring == 'matches':
+        # every variant is counted with a single lookup
+        return count_variant_genres(training, samples)
+    return dict((variant, score_genres(training, samples[variant], variant,
+        scoring)) for variant in samples)
+
+def score_batch(training, batch, scoring=None):
+    """
+    Return score_variants of each sample MIDI file of a batch. When counting
+    matches, the fingerprints of the whole batch are looked up at once.
+
+    @param VariantDB training: the combined peak pair databases
+    @param list[dict(tuple: numpy.ndarray)] batch: the fingerprints of each
+        sample MIDI file for each variant to match
+    @param str scoring: 'matches' or 'aligned'
+    @rtype: list[dict(tuple: dict(str: int))]
+    """
+    scoring = scoring or config.SCORING
+    if scoring == 'matches':
+        return count_batch_genres(training, batch)
+    return [score_variants(training, samples, scoring) for samples in batch]
+
+@profiled('align_genres')
+def align_genres(training, sample, variant=None, chunk_size=ALIGN_CHUNK,
+        max_rows=ALIGN_ROWS, min_aligned=MIN_ALIGNED, dominance=DOMINANCE):
+    """
+    Return the number of time-aligned matches per genre, as
+    Matches.get_genre_scores would: for each training track, only the
+    matches sharing its most common offset to the sample count.
+
+    The sample fingerprints are looked up in onset order, chunk_size at a
+    time (fewer if their postings add up to more than max_rows). A track
+    that could not catch up with the best track even if every remaining
+    fingerprint matched it at its best offset, as often as it repeats a
+    posting (see fpdb.get_track_repeats), is dropped, and its matches
+    are no longer counted. Once the best track has at least min_aligned
+    aligned matches and dominance times as many as any other, the remaining
+    fingerprints are not looked up at all. With dominance None, every
+    fingerprint is looked up, and nothing is dropped.
+
+    @param FingerprintDB training: the peak pair database, or a VariantDB
+    @param numpy.ndarray sample: the fingerprints of the sample MIDI file
+    @param tuple variant: the variant to match, if training is a VariantDB
+    @param int chunk_size: the number of fingerprints looked up at a time
+    @param int max_rows: the number of postings expanded at a time
+    @param int min_aligned: the aligned matches needed to stop early
+    @param float dominance: how many times more aligned matches than any
+        other track the best track needs to stop early
+    @rtype: dict(str: int)
+    """
+    sample = sample[np.argsort(sample['onset'], kind='mergesort')]
+    starts, ends = find_rows(training, sample['hash'], variant)
+    postings = np.r_[0, np.cumsum(ends - starts)]
+
+    # the offset histogram of every track, as sorted (track, offset) keys
+    # and the number of matches of each, the peak of each track's histogram
+    # and the tracks that are still counted
+    keys = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    peaks = np.zeros(len(training.track_names), dtype=np.int64)
+    candidates = np.ones(len(training.track_names), dtype=bool)
+
+    # a fingerprint adds at most as many matches to one offset of a track as
+    # the track has postings sharing a hash and an onset
+    repeats = training.count_repeats() if dominance is not None else None
+
+    start = 0
+    while start < len(sample):
+        end = np.searchsorted(postings, postings[start] + max_rows,
+            side='right') - 1
+        end = max(start + 1, min(start + chunk_size, end))
+
+        sample_rows, training_rows = expand(starts[start:end],
+            ends[start:end])
+        tracks = np.asarray(training.tracks[training_rows], dtype=np.int64)
+        counted = candidates[tracks]
+        sample_rows = sample_rows[counted] + start
+        training_rows = training_rows[counted]
+        tracks = tracks[counted]
+        start = end
+
+        offsets = np.asarray(training.onsets[training_rows]) - \
+            sample['onset'][sample_rows]
+        chunk_keys, chunk_counts = np.unique(tracks * OFFSET_SPAN + offsets +
+            OFFSET_SPAN // 2, return_counts=True)
+
+        # merge the chunk into the histogram: the counts of the keys already
+        # in it grow, and the other keys are inserted in order
+        positions = np.searchsorted(keys, chunk_keys)
+        found = positions < len(keys)
+        found[found] = keys[positions[found]] == chunk_keys[found]
+        counts[positions[found]] += chunk_counts[found]
+        chunk_counts[found] = counts[positions[found]]
+        keys = np.insert(keys, positions[~found], chunk_keys[~found])
+        counts = np.insert(counts, positions[~found], chunk_counts[~found])
+        np.maximum.at(peaks, chunk_keys // OFFSET_SPAN, chunk_counts)
+
+        if dominance is None:
+            continue
+
+        second, best = np.r_[0, np.sort(peaks)[-2:]][-2:]
+        if best >= min_aligned and best >= dominance * second:
+            break
+
+        candidates &= peaks + repeats * (len(sample) - start) >= best
+
+    scores = np.bincount(training.track_genres, weights=peaks,
+        minlength=len(training.genre_names))
+    return dict((training.genre_names[g], int(scores[g]))
+        for g in np.flatnonzero(scores))
+
+def find_rows(training, hashes, variant=None):
+    """
+    Return the range of training rows holding each of the given hashes, in
+    the training database or in one variant of it.
+
+    @param FingerprintDB training: the peak pair database, or a VariantDB
+    @param numpy.ndarray hashes: fingerprint hashes
+    @param tuple variant: the variant to look in, if training is a VariantDB
+    @rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    if variant is None:
+        return np.searchsorted(training.hashes, hashes, side='left'), \
+            np.searchsorted(training.hashes, hashes, side='right')
+    variant_ids = np.repeat(training.variants.index(variant), len(hashes))
+    return training.find(hashes, variant_ids)
+
+@profiled('join_variants')
+def join_variants(training, samples):
+    """
+    Return the matches between the fingerprints of the sample MIDI file and
+    each variant of the training databases, looking up the fingerprints of
+    every variant at once. The matches of a variant are the same as those of
+    join against the variant's own database, up to track ids.
+
+    @param VariantDB training: the combined peak pair databases
+    @param dict(tuple: numpy.ndarray) samples: the fingerprints of the sample
+        MIDI file for each variant to match
+    @rtype: dict(tuple: Matches)
+    """
+    variants, sample, bounds, starts, ends = find_variants(training, samples)
+    sample_rows, training_rows = expand(starts, ends)
+
+    sample_onsets = sample['onset'][sample_rows]
+    training_onsets = np.asarray(training.onsets[training_rows])
+    tracks = np.asarray(training.tracks[training_rows])
+    genres = np.asarray(training.genres[training_rows])
+
+    # the matches of each variant follow those of the previous one
+    bounds = np.r_[0, np.cumsum(ends - starts)][bounds]
+    matches = {}
+    for variant, start, end in zip(variants, bounds[:-1], bounds[1:]):
+        matches[variant] = Matches(training, sample_onsets[start:end],
+            training_onsets[start:end], tracks[start:end], genres[start:end])
+    return matches
+
+@profiled('count_variant_genres')
+def count_variant_genres(training, samples):
+    """
+    Return the number of matches per genre between the fingerprints of the
+    sample MIDI file and each variant of the training databases, as
+    Matches.get_genres would, without expanding the matches.
+
+    @param VariantDB training: the combined peak pair databases
+    @param dict(tuple: numpy.ndarray) samples: the fingerprints of the sample
+        MIDI file for each variant to match
+    @rtype: dict(tuple: dict(str: int))
+    """
+    variants = sorted(samples)
+    return dict(zip(variants, count_sample_genres(training, variants,
+        [samples[v] for v in variants])))
+
+@profiled('count_batch_genres')
+def count_batch_genres(training, batch):
+    """
+    Return count_variant_genres of each sample MIDI file of a batch, looking
+    up the fingerprints of the whole batch at once.
+
+    @param VariantDB training: the combined peak pair databases
+    @param list[dict(tuple: numpy.ndarray)] batch: the fingerprints of each
+        sample MIDI file for each variant to match
+    @rtype: list[dict(tuple: dict(str: int))]
+    """
+    keys = [(i, variant) for i in range(len(batch))
+        for variant in sorted(batch[i])]
+    counts = count_sample_genres(training, [variant for _, variant in keys],
+        [batch[i][variant] for i, variant in keys])
+
+    genres = [{} for _ in batch]
+    for (i, variant), variant_genres in zip(keys, counts):
+        genres[i][variant] = variant_genres
+    return genres
+
+def count_sample_genres(training, variants, samples):
+    """
+    Return the number of matches per genre of each array of fingerprints,
+    matched against the corresponding variant of the training databases.
+
+    @param VariantDB training: the combined peak pair databases
+    @param list[tuple] variants: the variant to match each array against
+    @param list[numpy.ndarray] samples: arrays of fingerprints
+    @rtype: list[dict(str: int)]
+    """
+    _, bounds, starts, ends = find_samples(training, variants, samples)
+    counts = training.count_genres(starts, ends)
+
+    # sum the counts of the fingerprints of each array
+    totals = np.r_[np.zeros((1, counts.shape[1]), dtype=counts.dtype),
+        np.cumsum(counts, axis=0)]
+    genres = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        sample_counts = totals[end] - totals[start]
+        genres.append(dict((training.genre_names[g], int(sample_counts[g]))
+            for g in np.flatnonzero(sample_counts)))
+    return genres
+
+def find_variants(training, samples):
+    """
+    Look up the fingerprints of every variant of the sample MIDI file at
+    once. Return the variants in order, their fingerprints one after the
+    other, the index at which the fingerprints of each variant start (and
+    the end of the last), and the range of training rows of each
+    fingerprint.
+
+    @param VariantDB training: the combined peak pair databases
+    @param dict(tuple: numpy.ndarray) samples: the fingerprints of the sample
+        MIDI file for each variant to match
+    @rtype: (list[tuple], numpy.ndarray, numpy.ndarray, numpy.ndarray,
+        numpy.ndarray)
+    """
+    variants = sorted(samples)
+    return (variants,) + find_samples(training, variants,
+        [samples[v] for v in variants])
+
+def find_samples(training, variants, samples):
+    """
+    Look up several arrays of fingerprints at once, each in its own variant
+    of the training databases. Return the fingerprints one after the other,
+    the index at which each array starts (and the end of the last), and the
+    range of training rows of each fingerprint.
+
+    @param VariantDB training: the combined peak pair databases
+    @param list[tuple] variants: the variant to look each array up in
+    @param list[numpy.ndarray] samples: arrays of fingerprints
+    @rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray)
+    """
+    sample = np.concatenate(samples) if samples \
+        else np.empty(0, dtype=fingerprint.FINGERPRINT)
+    sizes = [len(s) for s in samples]
+    variant_ids = np.repeat([training.variants.index(v) for v in variants],
+        sizes).astype(np.int64)
+
+    starts, ends = training.find(sample['hash'], variant_ids)
+    return sample, np.cumsum([0] + sizes), starts, ends
+
+def expand(starts, ends):
+    """
+    Expand each sample fingerprint, whose postings are the training rows from
+    its start to its end, into one row per posting. Return the sample row and
+    the training row of every posting.
+
+    @param numpy.ndarray starts: the first training row of each fingerprint
+    @param numpy.ndarray ends: the training row after the last of each
+        fingerprint
+    @rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    counts = ends - starts
+    total = counts.sum()
+    sample_rows = np.repeat(np.arange(len(counts)), counts)
+    group_starts = np.repeat(np.cumsum(counts) - counts, counts)
+    training_rows = np.repeat(starts, counts) + (np.arange(total) -
+        group_starts)
+    return sample_rows, training_rows
+
+def table_fingerprints(hashes):
+    """
+    Return the fingerprints of a dictionary of peak frequency hashes.
+
+    @param dict(int: PeakPair) hashes: the peak pair database
+    @rtype: numpy.ndarray
+    """
+    rows = [(h, pair.onset, 0) for h, pairs in hashes.items()
+        for pair in pairs]
+    return np.array(rows, dtype=fingerprint.FINGERPRINT)
 
 def get_most_frequent_note(pitches):
     """
@@ -319,13 +898,37 @@ def get_most_frequent_note(pitches):
     @param list[int] pitches: a list of MIDI pitches
     @rtype int
     """
-    tally = {}
-    for pitch in pitches:
-        note = Note(int(pitch))
-        tally[note] = tally.get(note, 0) + 1
-    most_frequent = nlargest(TOP_MOST_FREQUENT, tally, key=tally.get)
+    return get_most_frequent_notes(pitches, 1)[0]
+
+def get_most_frequent_notes(pitches, n=TOP_MOST_FREQUENT):
+    """
+    Return the n MIDI pitches (from 0 to 127) that occur the most often in the
+    pitches of a MIDI file, most frequent first. Pitches that occur equally
+    often are ordered from lowest to highest.
 
-    return most_frequent[0].midi_pitch
+    @param list[int] pitches: a list of MIDI pitches
+    @param int n: the number of pitches to return
+    @rtype: list[int]
+    """
+    counts = np.bincount(np.asarray(pitches, dtype=np.int64), minlength=128)
+    most_frequent = np.argsort(-counts, kind='mergesort')[:n]
+    return most_frequent[counts[most_frequent] > 0].tolist()
+
+def add_fingerprints(file, genre, hashes, fingerprints):
+    """
+    Add or append each fingerprint to the hashes dictionary as a PeakPair
+    with the associated file name and genre.
+
+    @param str file: the name of the file
+    @param str genre: the genre of the file
+    @param dict(int: PeakPair) hashes: the peak pair database
+    @param numpy.ndarray fingerprints: fingerprints as returned by the
+        fingerprint module
+    @rtype: None
+    """
+    for h, onset in zip(fingerprints['hash'].tolist(),
+            fingerprints['onset'].tolist()):
+        hashes.setdefault(h, []).append(PeakPair(onset, file, genre))
 
 def hash_time_diff(file, genre, hashes, notes):
     """
@@ -339,13 +942,7 @@ def hash_time_diff(file, genre, hashes, notes):
     @param list[int] notes: a list of MIDI notes in the madmom library format
     @rtype: None
     """
-    for i in range(len(notes) - (FAN_FACTOR + 1)):
-        for j in range(1, FAN_FACTOR + 1):
-
-            # hash = later offset - earlier offset
-            h = notes[i+j][ONSET] - notes[i][ONSET]
-            pair = PeakPair(notes[i][ONSET], file, genre)
-            hashes.setdefault(h, []).append(pair)
+    add_fingerprints(file, genre, hashes, fingerprint.time_diff(notes))
 
 def hash_time_diff_percentile(file, genre, hashes, notes):
     """
@@ -360,31 +957,36 @@ def hash_time_diff_percentile(file, genre, hashes, notes):
     @param list[int] notes: a list of MIDI notes in the madmom library format
     @rtype: None
     """
-    total_length = notes[-1][ONSET]
-    for i in range(len(notes) - (FAN_FACTOR + 1)):
-        for j in range(1, FAN_FACTOR + 1):
-
-            # hash is of the form onset_diff|percentile
-            # ex: diff = 20, percentile = 50, hash = 2050
-            percentile = notes[i][ONSET] / float(total_length) * 100
-            h = (notes[i+j][ONSET] - notes[i][ONSET]) * 100 + int(percentile)
-            pair = PeakPair(notes[i][ONSET], file, genre)
-            hashes.setdefault(h, []).append(pair)
+    add_fingerprints(file, genre, hashes,
+        fingerprint.time_diff_percentile(notes))
 
 def hash_time_diff_pitch(file, genre, hashes, notes):
-    for i in range(len(notes) - (FAN_FACTOR + 1)):
-        for j in range(1, FAN_FACTOR + 1):
-            h = notes[i+j][ONSET] - notes[i][ONSET] * 1000 + notes[i][PITCH]
-            pair = PeakPair(notes[i][ONSET], file, genre)
-            hashes.setdefault(h, []).append(pair)
+    """
+    Add or append to the hashes dictionary with a hash that considers the
+    peak pair's timestamps and the pitch of the earlier peak.
+
+    @param str file: the name of the file
+    @param str genre: the genre of the file
+    @param dict(int: PeakPair) hashes: the peak pair database
+    @param list[int] notes: a list of MIDI notes in the madmom library format
+    @rtype: None
+    """
+    add_fingerprints(file, genre, hashes, fingerprint.time_diff_pitch(notes))
 
 def hash_time_diff_pitch_percentile(file, genre, hashes, notes):
-    for i in range(len(notes) - (FAN_FACTOR + 1)):
-        for j in range(1, FAN_FACTOR + 1):
-            percentile = notes[i][PITCH] / 127.0 * 10
-            h = notes[i+j][ONSET] - notes[i][ONSET] * 10 + int(percentile)
-            pair = PeakPair(notes[i][ONSET], file, genre)
-            hashes.setdefault(h, []).append(pair)
+    """
+    Add or append to the hashes dictionary with a hash that considers the
+    peak pair's timestamps and the pitch of the earlier peak as a percentile
+    of the MIDI pitch range.
+
+    @param str file: the name of the file
+    @param str genre: the genre of the file
+    @param dict(int: PeakPair) hashes: the peak pair database
+    @param list[int] notes: a list of MIDI notes in the madmom library format
+    @rtype: None
+    """
+    add_fingerprints(file, genre, hashes,
+        fingerprint.time_diff_pitch_percentile(notes))
 
 def plot_graph(buckets):
     """
@@ -396,6 +998,9 @@ def plot_graph(buckets):
         matches for sample MIDI file
     @rtype: None
     """
+    # only imported when plotting, since it is slow to import
+    import matplotlib.pyplot as plt
+
     for key, value in buckets.items():
         plt.plot(
             value.get_training_times(),
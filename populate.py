@@ -1,10 +1,12 @@
 import numpy as np
 # import tensorflow as tf
+import sys
 import pickle
 import pprint
 import warnings
 
-from madmom.utils.midi import *
+from notecache import load_midi
+from barindex import BarIndex, StreamBuilder, INDEX_NAME, INDEX_EXT
 from os import listdir
 
 
@@ -26,8 +28,13 @@ FEATURE = 0
 # 1: highest first note of each bar, tracking bars
 
 def main():
+    # --stream builds the index with bounded memory, without the table dict
+    stream = '--stream' in sys.argv
+    if stream:
+        sys.argv.remove('--stream')
+
     if len(sys.argv) != 2:
-        print "usage: requires exactly one argument"
+        print "usage: populate.py [--stream] <int>"
         return
 
     if int(sys.argv[1]) not in range(2):
@@ -42,6 +49,17 @@ def main():
     np.set_printoptions(threshold=np.nan)
     # np.set_printoptions(edgeitems=10)
 
+    if stream:
+        builder = StreamBuilder(INDEX_NAME + INDEX_EXT)
+        try:
+            for track in corpus_bars():
+                builder.add_track(*track)
+            index = builder.build()
+        finally:
+            builder.close()
+        export_index(index)
+        return
+
     for genre in GENRES:
         for file in listdir(genre):
             if not file.startswith('.'):
@@ -49,10 +67,32 @@ def main():
 
     pprint.pprint(TABLE)
     pickle.dump(TABLE, open("table.p", "wb"))
+    BarIndex.from_table(TABLE).save(INDEX_NAME + INDEX_EXT)
     export_table_old()
 
+# yield the (file, genre, pitches, bars) of every training track, one track at
+# a time
+def corpus_bars():
+    for genre in GENRES:
+        for file in listdir(genre):
+            if not file.startswith('.'):
+                bars = track_bars(file, genre + '/')
+                if bars is not None:
+                    yield (file,) + bars
+
 def midi_train(table, file, genre=""):
-    midi = MIDIFile.from_file(genre + file)
+    bars = track_bars(file, genre)
+    if bars is None:
+        return
+
+    genre_trimmed, highest, bars = bars
+    for pitch, bar in zip(highest, bars):
+        add_note(table, pitch, file, genre_trimmed, bar)
+
+# return the genre of a file, the highest note of each of its bars and the bar
+# it occurs in, or None if its bars cannot be found
+def track_bars(file, genre=""):
+    midi = load_midi(genre + file)
 
     if genre != "":
         genre_trimmed = genre.split("-")[1][:-1]
@@ -66,24 +106,17 @@ def midi_train(table, file, genre=""):
 
     ticks_per_bar = get_ticks_per_bar(midi, notes, file)
     if ticks_per_bar == None:
-        return
+        return None
 
     # wow the units check out!
     # bars_in_track = beats / beats_per_bar
 
-    # cursor is the index (or row) of a note matrix
-    cursor = 0
-
-    while cursor < len(notes) - 1:
-        highest, highest_onset, cursor_moved_by = get_highest(notes, cursor, ticks_per_bar)
+    highest, highest_onsets = get_bar_highest(notes, ticks_per_bar)
 
-        # if FEATURE == 0:
-        #     add_note(table, highest, file, genre_trimmed, highest_onset)
-        # elif FEATURE == 1:
-        bar = highest_onset // ticks_per_bar
-        add_note(table, highest, file, genre_trimmed, bar)
-    
-        cursor += cursor_moved_by
+    # if FEATURE == 0:
+    #     return genre_trimmed, highest, highest_onsets
+    # elif FEATURE == 1:
+    return genre_trimmed, highest, highest_onsets // ticks_per_bar
 
 def get_ticks_per_bar(midi, notes, file):
     # total number of ticks divided by resolution (number of ticks per beat)
@@ -91,64 +124,79 @@ def get_ticks_per_bar(midi, notes, file):
 
     # find time signature numerator, only works for type 1 midi files
     # for type 1 midi, each channel (voice) is contained in its own track
-    events = midi.tracks[0].events
-    event_index = find_event(events, TimeSignatureEvent)
-    if event_index == None:
+    if midi.time_signature == None:
         print 'Time Signature not found for {}'.format(file)
         return None
 
-    beats_per_bar = events[event_index].data[ONSET]
+    beats_per_bar = midi.time_signature[ONSET]
     return beats_per_bar * midi.resolution
 
 
-# return the highest note in the current bar and how many notes were parsed
-def get_highest(notes, cursor, ticks_per_bar):
-    cursor_moved_by = 0
-    highest = 0
-    highest_onset = 0
-    onset = notes[cursor][ONSET]
-    next_bar = onset + ticks_per_bar
-
-    while notes[cursor][ONSET] < next_bar:
-        if notes[cursor][ONSET] == onset:
-            if notes[cursor][PITCH] > highest:
-                highest = notes[cursor][PITCH]
-                highest_onset = notes[cursor][ONSET]
-        
-        if cursor < len(notes) - 1:
-            cursor += 1
-            cursor_moved_by += 1
-        else:
-            break
-
-    return highest, highest_onset, cursor_moved_by
+# return the highest note at the first onset of each bar and its onset, for
+# every bar of the track. A bar starts at the first note after the previous
+# bar and spans ticks_per_bar ticks from its onset, so bars follow the notes
+# rather than a fixed grid. Notes are sorted by onset, as madmom returns them.
+def get_bar_highest(notes, ticks_per_bar):
+    onsets = notes[:,ONSET]
+    pitches = notes[:,PITCH]
+    if len(notes) < 2:
+        return np.empty(0), np.empty(0)
+
+    # the note after the bar starting at each note, never past the last note
+    ends = np.minimum(np.searchsorted(onsets, onsets + ticks_per_bar),
+        len(notes) - 1)
+
+    # follow the bars from the first note, one index per bar
+    starts = []
+    cursor = 0
+    while cursor < len(notes) - 1:
+        starts.append(cursor)
+        cursor = ends[cursor]
+    starts = np.array(starts)
+
+    # the highest pitch among the notes at the first onset of each bar
+    chords = np.searchsorted(onsets, onsets[starts], side='right')
+    bounds = np.ravel(np.c_[starts, chords])
+    highest = np.maximum.reduceat(np.r_[pitches, 0], bounds)[::2]
+
+    # pitches are compared to 0, so a bar of rests is (0, 0)
+    highest = np.maximum(highest, 0)
+    highest_onsets = np.where(highest > 0, onsets[starts], 0)
+    return highest, highest_onsets
 
 def add_note(table, pitch, file, genre_trimmed, onset):
     # add to table if it's a new pitch
-    if pitch not in table.keys():
+    if pitch not in table:
         table[pitch] = [(file, genre_trimmed, onset)]
 
     # append if pitch already exists as a key
     else:
         table[pitch].append((file, genre_trimmed, onset))
 
-def find_event(events, event_type):
-    for i in range(len(events)):
-        if isinstance(events[i], event_type):
-            return i
-    return None
-
 def export_table_old():
     file = open(TABLE_FILE, 'w')
     for tick, pitch_name_pairs in TABLE.items():
-        row = str(tick) + SEPARATOR
+        values = [str(tick)]
         for pair in pitch_name_pairs:
-            for value in pair:
-                row += str(value) + SEPARATOR
-            # row += str(pair[0]) + SEPARATOR + str(pair[1]) + SEPARATOR
-        row += '\n'
-        file.write(row)
+            values.extend(str(value) for value in pair)
+        file.write(SEPARATOR.join(values) + SEPARATOR + '\n')
 
+# write the postings of an index to TABLE_FILE as export_table_old does, one
+# row per pitch, without holding a whole row in memory
+def export_index(index, chunk_size=65536):
+    file = open(TABLE_FILE, 'w')
+    for i, pitch in enumerate(index.pitches):
+        file.write(str(pitch) + SEPARATOR)
+        for start in range(index.starts[i], index.starts[i + 1], chunk_size):
+            end = min(start + chunk_size, index.starts[i + 1])
+            values = []
+            for title, genre, bar in zip(index.titles[start:end],
+                    index.genres[start:end], index.bars[start:end]):
+                values.extend((index.title_names[title],
+                    index.genre_names[genre], str(float(bar))))
+            file.write(SEPARATOR.join(values) + SEPARATOR)
+        file.write('\n')
+    file.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,252 @@
+import numpy as np
+import atexit
+import json
+import resource
+import sys
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+from os import environ
+
+# Stages of the pipeline (parsing MIDI files, analyzing voices, hashing,
+# matching, exporting tables, training) are wrapped with the profiled
+# decorator or the stage context manager. Profiling is off by default, and a
+# disabled stage costs a single check. It is turned on with enable, or by
+# setting these environment variables before running any script:
+#
+#   PROFILE_REPORT=report.json python melody.py
+#   PROFILE_CPROFILE=melody.prof python melody.py
+#
+# The report holds the number of calls of each stage, their total, mean,
+# median (p50), 99th percentile and maximum wall time, and the peak memory of
+# the process after the stage ran. Stages can be nested, and the time of a
+# stage includes the stages it calls. Stages run in worker processes (with
+# --jobs greater than 1) are sent back along with each result and merged into
+# the report, but cProfile only sees the parent process, so profile with a
+# single job to get the statistics of every function.
+
+# environment variables holding the paths of the JSON report and of the
+# cProfile statistics
+REPORT_ENV = 'PROFILE_REPORT'
+CPROFILE_ENV = 'PROFILE_CPROFILE'
+
+# whether stages are being timed
+ENABLED = False
+
+# the stages timed in this process, by name
+STAGES = {}
+
+class Stage():
+    """
+    The timings of every call of a stage.
+
+    === Attributes ===
+    @param str name: the name of the stage
+    @param list[float] times: the wall time of each call, in seconds
+    @param int peak_rss: the largest peak memory of the process after a call,
+        in kilobytes
+    @param int rss_growth: how much the calls raised the peak memory of the
+        process, in kilobytes
+    """
+
+    def __init__(self, name):
+        """
+        Creates a stage that has not been called yet.
+
+        @rtype: None
+        """
+        self.name = name
+        self.times = []
+        self.peak_rss = 0
+        self.rss_growth = 0
+
+    def add(self, seconds, rss_before, rss_after):
+        """
+        Record a call of this stage.
+
+        @param Stage self: this stage
+        @param float seconds: the wall time of the call
+        @param int rss_before: the peak memory before the call, in kilobytes
+        @param int rss_after: the peak memory after the call, in kilobytes
+        @rtype: None
+        """
+        self.times.append(seconds)
+        self.peak_rss = max(self.peak_rss, rss_after)
+        self.rss_growth += rss_after - rss_before
+
+    def merge(self, other):
+        """
+        Add the calls of another stage of the same name, timed in another
+        process.
+
+        @param Stage self: this stage
+        @param Stage other: the stage to add the calls of
+        @rtype: None
+        """
+        self.times.extend(other.times)
+        self.peak_rss = max(self.peak_rss, other.peak_rss)
+        self.rss_growth += other.rss_growth
+
+    def get_report(self):
+        """
+        Return the summary of the calls of this stage.
+
+        @param Stage self: this stage
+        @rtype: dict
+        """
+        times = np.array(self.times)
+        return {
+            'calls': len(times),
+            'total_seconds': round(times.sum(), 6),
+            'mean_seconds': round(times.mean(), 6),
+            'p50_seconds': round(np.percentile(times, 50), 6),
+            'p99_seconds': round(np.percentile(times, 99), 6),
+            'max_seconds': round(times.max(), 6),
+            'peak_rss_mb': round(self.peak_rss / 1024., 2),
+            'rss_growth_mb': round(self.rss_growth / 1024., 2)
+        }
+
+def get_rss():
+    """
+    Return the peak memory of this process, in kilobytes on Linux.
+
+    @rtype: int
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+@contextmanager
+def stage(name):
+    """
+    Time the body of a with statement as a call of the stage called name.
+
+    @param str name: the name of the stage
+    @rtype: generator
+    """
+    if not ENABLED:
+        yield
+        return
+
+    rss_before = get_rss()
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        if name not in STAGES:
+            STAGES[name] = Stage(name)
+        STAGES[name].add(seconds, rss_before, get_rss())
+
+def profiled(name):
+    """
+    Return a decorator timing each call of a function as the stage called
+    name.
+
+    @param str name: the name of the stage
+    @rtype: function
+    """
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+class WorkerTask():
+    """
+    A function run by a worker process, returning the stages it timed along
+    with its result, since the stages of workers are otherwise lost.
+
+    === Attributes ===
+    @param function function: the function applied to each task
+    """
+
+    def __init__(self, function):
+        """
+        Creates a WorkerTask applying function.
+
+        @param function function: a picklable function taking a single task
+        @rtype: None
+        """
+        self.function = function
+
+    def __call__(self, task):
+        """
+        Return the result of the function on task and the stages timed while
+        computing it.
+
+        @param WorkerTask self: this worker task
+        @param object task: the task
+        @rtype: (object, list[Stage])
+        """
+        # the worker inherits the stages of the parent when it is forked
+        STAGES.clear()
+        result = self.function(task)
+        return result, STAGES.values()
+
+def merge_stages(stages):
+    """
+    Add the calls of stages timed by a worker process to this process.
+
+    @param list[Stage] stages: the stages returned by a WorkerTask
+    @rtype: None
+    """
+    for other in stages:
+        if other.name not in STAGES:
+            STAGES[other.name] = Stage(other.name)
+        STAGES[other.name].merge(other)
+
+def get_report():
+    """
+    Return the report of every stage timed so far.
+
+    @rtype: dict
+    """
+    return {
+        'argv': sys.argv,
+        'peak_rss_mb': round(get_rss() / 1024., 2),
+        'stages': dict((name, STAGES[name].get_report()) for name in STAGES)
+    }
+
+def write_report(path):
+    """
+    Write the report of every stage timed so far to path, as JSON.
+
+    @param str path: the path of the report
+    @rtype: None
+    """
+    with open(path, 'w') as f:
+        json.dump(get_report(), f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def enable(report=None, cprofile=None):
+    """
+    Start timing stages. At exit, the report is written to report if given,
+    and if cprofile is given the whole process is profiled with cProfile and
+    its statistics are dumped there (they can be read with pstats).
+
+    @param str report: the path of the JSON report
+    @param str cprofile: the path of the cProfile statistics
+    @rtype: None
+    """
+    global ENABLED
+    ENABLED = True
+
+    if cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def dump_stats():
+            profiler.disable()
+            profiler.dump_stats(cprofile)
+        atexit.register(dump_stats)
+
+    if report:
+        atexit.register(write_report, report)
+
+if environ.get(REPORT_ENV) or environ.get(CPROFILE_ENV):
+    enable(environ.get(REPORT_ENV), environ.get(CPROFILE_ENV))
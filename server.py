@@ -0,0 +1,238 @@
+import config
+import json
+import melody
+import threading
+import time
+
+from Queue import Queue, Empty
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from sys import argv
+from config import *
+from classifier import Classifier
+from fingerprint import get_config
+
+# A long-lived classification service. The training databases are loaded
+# (memory-mapped) once at startup, so classifying an upload only costs
+# parsing it, fingerprinting it and one lookup shared by the batch it is
+# matched with, instead of the startup of melody.py (see classifier.py).
+# Uploads that cannot be read get a 400 response, and any other failure a 500
+# response.
+#
+#   python server.py [port]
+#   curl --data-binary @song.mid http://localhost:8000/classify
+
+HOST = 'localhost'
+PORT = 8000
+
+# requests are classified in batches of at most BATCH_SIZE, waiting at most
+# BATCH_WAIT seconds for a batch to fill up
+BATCH_SIZE = 16
+BATCH_WAIT = 0.005
+
+class Request():
+    """
+    A classification request waiting for its result.
+
+    === Attributes ===
+    @param str content: the raw bytes of the uploaded MIDI file
+    @param float received: the time at which the request was received
+    @param dict(tuple: numpy.ndarray) fingerprints: the fingerprints of the
+        MIDI file, once computed
+    @param dict result: the classification, once done
+    @param str error: the reason the classification failed, if it did
+    @param int status: the HTTP status of the response
+    """
+
+    def __init__(self, content):
+        """
+        Creates a request for the given MIDI file.
+
+        @param str content: the raw bytes of the uploaded MIDI file
+        @rtype: None
+        """
+        self.content = content
+        self.received = time.time()
+        self.fingerprints = None
+        self.result = None
+        self.error = None
+        self.status = None
+        self._done = threading.Event()
+
+    def finish(self, result=None, error=None, status=500):
+        """
+        Store the result (or error, and the status it is reported with) of
+        this request and wake up its handler.
+
+        @param Request self: this request
+        @rtype: None
+        """
+        self.result = result
+        self.error = error
+        self.status = 200 if error is None else status
+        self._done.set()
+
+    def wait(self):
+        """
+        Block until this request has been classified.
+
+        @param Request self: this request
+        @rtype: None
+        """
+        self._done.wait()
+
+class Batcher(threading.Thread):
+    """
+    A worker thread that takes queued requests in batches and classifies them.
+    Uploads are parsed and fingerprinted by the threads handling them, and
+    the batcher matches the fingerprints of a whole batch at once.
+
+    === Attributes ===
+    @param Classifier classifier: the classifier used for every request
+    @param Queue queue: the requests waiting to be classified
+    """
+
+    def __init__(self, classifier):
+        """
+        Creates a daemon batcher for the given classifier.
+
+        @rtype: None
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.classifier = classifier
+        self.queue = Queue()
+
+    def submit(self, request):
+        """
+        Fingerprint a request, then queue it and block until it has been
+        classified.
+
+        @param Batcher self: this batcher
+        @param Request request: the request to classify
+        @rtype: None
+        """
+        try:
+            notes = self.classifier.parse(request.content)
+        except Exception as e:
+            # the upload is not a MIDI file that can be read
+            request.finish(error='{}: {}'.format(type(e).__name__, e),
+                status=400)
+            return
+
+        try:
+            request.fingerprints = self.classifier.fingerprint(notes)
+        except Exception as e:
+            request.finish(error='{}: {}'.format(type(e).__name__, e))
+            return
+
+        self.queue.put(request)
+        request.wait()
+
+    def classify(self, batch):
+        """
+        Classify a batch of fingerprinted requests, finishing each of them.
+
+        @param Batcher self: this batcher
+        @param list[Request] batch: the requests to classify
+        @rtype: None
+        """
+        try:
+            results = self.classifier.classify_batch([request.fingerprints
+                for request in batch])
+        except Exception as e:
+            for request in batch:
+                request.finish(error='{}: {}'.format(type(e).__name__, e))
+            return
+
+        for request, result in zip(batch, results):
+            request.finish(result=result)
+
+    def run(self):
+        """
+        Classify queued requests forever, batching those that arrive within
+        BATCH_WAIT seconds of each other.
+
+        @param Batcher self: this batcher
+        @rtype: None
+        """
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + BATCH_WAIT
+            while len(batch) < BATCH_SIZE:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Empty:
+                    break
+            self.classify(batch)
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Handles POST /classify (with the MIDI file as the request body) and
+    GET /health.
+    """
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(404, {'error': 'not found'})
+            return
+        self.send_json(200, {'status': 'ok'})
+
+    def do_POST(self):
+        if self.path != '/classify':
+            self.send_json(404, {'error': 'not found'})
+            return
+
+        length = int(self.headers.getheader('content-length', 0))
+        request = Request(self.rfile.read(length))
+        self.server.batcher.submit(request)
+
+        latency = round((time.time() - request.received) * 1000, 2)
+        self.log_message('classified in %s ms', latency)
+        if request.error is not None:
+            self.send_json(request.status, {'error': request.error,
+                'latency_ms': latency})
+            return
+
+        response = dict(request.result)
+        response['latency_ms'] = latency
+        self.send_json(200, response)
+
+    def send_json(self, status, body):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+class Server(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server handling each connection in its own thread, sharing one
+    batcher.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, batcher):
+        HTTPServer.__init__(self, address, Handler)
+        self.batcher = batcher
+
+def main():
+    load_settings()
+
+    # classify against the databases built with the same options
+    melody.CONFIG = get_config(argv)
+    config.SCORING = get_option(argv, '--scoring', config.SCORING)
+    port = int(argv[1]) if len(argv) > 1 else PORT
+    batcher = Batcher(Classifier())
+    batcher.start()
+
+    server = Server((HOST, port), batcher)
+    print "classifying on http://{}:{}/classify".format(HOST, port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import unittest
+
+import numpy as np
+
+import fingerprint
+
+from config import ONSET, PITCH
+from fingerprint import FingerprintConfig, pack, unpack, windows
+
+def make_notes(onsets, pitches):
+    # peak notes in the madmom library format
+    notes = np.zeros((len(onsets), 5))
+    notes[:,ONSET] = onsets
+    notes[:,PITCH] = pitches
+    return notes
+
+class TestPackedHashes(unittest.TestCase):
+
+    def setUp(self):
+        self.random = np.random.RandomState(0)
+
+    def test_default_layout_is_packed(self):
+        config = FingerprintConfig()
+        self.assertEqual(config.layout, 'packed')
+        self.assertNotEqual(config.get_name(),
+            FingerprintConfig(layout='decimal').get_name())
+
+    def test_round_trip(self):
+        config = FingerprintConfig(fan_factor=3, quantum=4)
+        onsets = windows(np.cumsum(self.random.randint(0, 5000, 200)),
+            config.fan_factor)
+        anchor = self.random.randint(0, 128, (len(onsets), 1))
+        target = self.random.randint(0, 128, (len(onsets), 3))
+        percentile = self.random.randint(0, 101, (len(onsets), 1))
+
+        parts = unpack(pack(onsets, config, anchor, target, percentile))
+        shape = parts.shape
+        np.testing.assert_array_equal(parts['delta'],
+            (onsets[:,1:] - onsets[:,:1]) // config.quantum)
+        np.testing.assert_array_equal(parts['anchor'],
+            np.broadcast_to(anchor, shape))
+        np.testing.assert_array_equal(parts['target'], target)
+        np.testing.assert_array_equal(parts['percentile'],
+            np.broadcast_to(percentile, shape))
+
+    def test_hash_functions_round_trip(self):
+        config = FingerprintConfig(fan_factor=2)
+        notes = make_notes([0, 10, 30, 60, 100], [60, 62, 64, 65, 67])
+
+        parts = unpack(fingerprint.time_diff_pitch(notes, config=config)[
+            'hash'])
+        np.testing.assert_array_equal(parts['delta'], [10, 30, 20, 50])
+        np.testing.assert_array_equal(parts['anchor'], [60, 60, 62, 62])
+        np.testing.assert_array_equal(parts['target'], [62, 64, 64, 65])
+
+        parts = unpack(fingerprint.time_diff_percentile(notes,
+            config=config)['hash'])
+        np.testing.assert_array_equal(parts['delta'], [10, 30, 20, 50])
+        np.testing.assert_array_equal(parts['percentile'], [0, 0, 10, 10])
+
+    def test_no_collisions(self):
+        # every combination of parts in range has its own hash
+        config = FingerprintConfig(fan_factor=1)
+        delta, anchor, target, percentile = [part.ravel() for part in
+            np.meshgrid(np.arange(0, 2 ** 32, 2 ** 27), np.arange(0, 128, 9),
+                np.arange(0, 128, 7), np.arange(0, 101, 5), indexing='ij')]
+        onsets = np.c_[np.zeros(len(delta)), delta]
+
+        hashes = pack(onsets, config, anchor[:,np.newaxis],
+            target[:,np.newaxis], percentile[:,np.newaxis])
+        self.assertEqual(len(np.unique(hashes)), len(delta))
+        self.assertTrue((hashes >= 0).all())
+
+    def test_percentiles_of_a_track_without_length(self):
+        # every note starts at 0, so there is no length to divide by
+        notes = make_notes([0] * 5, [60, 62, 64, 65, 67])
+        for layout in fingerprint.LAYOUTS:
+            config = FingerprintConfig(fan_factor=2, layout=layout)
+            hashes = fingerprint.time_diff_percentile(notes,
+                config=config)['hash']
+            np.testing.assert_array_equal(hashes, np.zeros(4))
+
+    def test_decimal_collision_is_resolved(self):
+        # a 40 tick step from pitch 60 and a 30 tick step from pitch 70 have
+        # the same decimal hash, 40 - 0 * 1000 + 60 = 30 - 0 * 1000 + 70
+        first = make_notes([0, 40, 80], [60, 62, 64])
+        second = make_notes([0, 30, 80], [70, 62, 64])
+
+        def hashes(config):
+            return [fingerprint.time_diff_pitch(notes, config=config)['hash']
+                for notes in [first, second]]
+
+        decimal = hashes(FingerprintConfig(fan_factor=1, layout='decimal'))
+        np.testing.assert_array_equal(decimal[0], decimal[1])
+        packed = hashes(FingerprintConfig(fan_factor=1))
+        self.assertNotEqual(packed[0][0], packed[1][0])
+
+if __name__ == '__main__':
+    unittest.main()
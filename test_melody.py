@@ -0,0 +1,86 @@
+import shutil
+import tempfile
+import unittest
+
+from config import FEATURE_EXT, GENRES
+from featurestore import read_table
+from os import chdir, getcwd, listdir, makedirs, remove
+from os.path import abspath, dirname, join
+
+import melody
+
+ROOT = abspath(dirname(__file__))
+
+def get_corpus(count):
+    # the first count tracks of each genre and of the test set
+    corpus = dict((directory, sorted(file for file in listdir(join(ROOT,
+        directory)) if not file.startswith('.'))[:count])
+        for directory in ['midi-' + genre for genre in GENRES] + ['test-set'])
+    return corpus
+
+def make_corpus(root, corpus):
+    for directory in ['features', 'test-features', 'pickles']:
+        makedirs(join(root, directory))
+    for directory, files in corpus.items():
+        makedirs(join(root, directory))
+        for file in files:
+            shutil.copy(join(ROOT, directory, file), join(root, directory))
+
+def export(root):
+    # export the features of the corpus in root, returning the training
+    # features of each hash function by track
+    cwd = getcwd()
+    chdir(root)
+    try:
+        melody.export_features(jobs=1)
+        tables = {}
+        for h in range(len(melody.H_FUNCTIONS)):
+            names, values, _ = read_table(melody.get_features_name(h) +
+                FEATURE_EXT)
+            tables[h] = dict(zip(names, values.tolist()))
+        return tables
+    finally:
+        chdir(cwd)
+
+class TestExportFeatures(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_update_matches_fresh_build(self):
+        corpus = get_corpus(3)
+        classical, rock = ['midi-' + genre for genre in GENRES]
+        removed, modified, replacement = corpus[rock]
+
+        # the final training set: a classical track added, a rock track
+        # removed and another one modified
+        final = dict(corpus)
+        final[rock] = [modified]
+
+        def modify(root):
+            shutil.copy(join(ROOT, rock, replacement),
+                join(root, rock, modified))
+
+        # build from the older state, then update it
+        updated = join(self.root, 'updated')
+        old = dict(corpus)
+        old[classical] = corpus[classical][:2]
+        old[rock] = [removed, modified]
+        make_corpus(updated, old)
+        export(updated)
+        remove(join(updated, rock, removed))
+        shutil.copy(join(ROOT, classical, corpus[classical][2]),
+            join(updated, classical))
+        modify(updated)
+
+        fresh = join(self.root, 'fresh')
+        make_corpus(fresh, final)
+        modify(fresh)
+
+        self.assertEqual(export(updated), export(fresh))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+import numpy as np
+
+from fingerprint import FINGERPRINT
+from fpdb import Builder
+from pitches import align_genres
+
+def make_fingerprints(hashes, onsets):
+    fingerprints = np.zeros(len(hashes), dtype=FINGERPRINT)
+    fingerprints['hash'] = hashes
+    fingerprints['onset'] = onsets
+    return fingerprints
+
+class TestAlignGenres(unittest.TestCase):
+
+    def test_repeated_postings_are_not_pruned(self):
+        # the rock track matches the first three sample fingerprints, the
+        # classical track holds each of the last two three times, so it ends
+        # with twice as many aligned matches
+        builder = Builder()
+        builder.add_track('rock.mid', 'rock',
+            make_fingerprints([10, 11, 12], [0, 1, 2]))
+        builder.add_track('classical.mid', 'classical',
+            make_fingerprints([13] * 3 + [14] * 3, [3] * 3 + [4] * 3))
+        training = builder.build()
+        sample = make_fingerprints([10, 11, 12, 13, 14], [0, 1, 2, 3, 4])
+
+        np.testing.assert_array_equal(training.count_repeats(), [1, 3])
+        expected = {'classical': 6, 'rock': 3}
+        self.assertEqual(align_genres(training, sample, dominance=None),
+            expected)
+        self.assertEqual(align_genres(training, sample, chunk_size=1),
+            expected)
+
+if __name__ == '__main__':
+    unittest.main()